@@ -0,0 +1,143 @@
+###############################################################################
+##                                                                           ##
+##             ________________________________     _________   _________    ##
+##            // ____  ____  _________________/    // ____  /  // ____  /    ##
+##           // /  // /  // /                     // /  // /  // /  // /     ##
+##          // /  // /  // /_____  _________     // /__// /__//_/__// /      ##
+##         // /  // /  // ______/ // ______/    // __________________/       ##
+##        // /  // /  // /_______//_/_____     // /        // /_____         ##
+##       // /  // /  // _______________  /    // /        //_____  /         ##
+##      // /  // /  // /_____  // /__// /    // /        ___   // /          ##
+##     // /__// /  // ______/ //_______/    // /        // /__// /           ##
+##    //_______/  //_/                     //_/        //_______/            ##
+##                                                                           ##
+##                                                             Stefan Radman ##
+###############################################################################
+
+### IMPORTS ###################################################################
+
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+from collections import namedtuple
+from PIL import Image
+
+import numpy as np
+
+import VIMPRO_Processor as vp
+
+### DATA ######################################################################
+
+# Quantizers compared by default, i.e. all the backends plus the seeded
+# k-means variants
+default_quantizers = list(vp.quantizers)+[name+"+kmeans" for name in
+    vp.quantizers if name != "kmeans"]
+
+# Modules whose import latency is measured by default, from the innermost to
+# the entry point (which every batch worker and GUI start pays for)
+default_import_modules = ["VIMPRO_Data", "VIMPRO_Processor", "VIMPRO"]
+
+### FUNCTIONS #################################################################
+
+# Time (best of repeats runs, in seconds) and error of a single quantizer run.
+# The error is the mean squared distance of the (opaque) pixels from their
+# nearest palette color
+BenchmarkResult = namedtuple("BenchmarkResult",
+    ["quantizer", "seconds", "error"])
+
+# Run each of the quantizers (names as accepted by vp.run_quantizer) on the
+# same data, i.e. the pixels of image (a PIL image or an array), resized to at
+# most maxpixels pixels, and return a list of BenchmarkResult. All other kwargs
+# (e.g. k, seed, fidelity) are passed to the quantizers
+def benchmark_quantizers(image, **kwargs) :
+    names = kwargs.pop("quantizers", default_quantizers)
+    repeats = max(1, kwargs.pop("repeats", 3))
+    max_pixels = kwargs.pop("maxpixels", None)
+    if isinstance(image, np.ndarray) :
+        image = Image.fromarray(image)
+    image = image.convert("RGBA")
+    if max_pixels is not None and image.width*image.height > max_pixels :
+        scale = np.sqrt(max_pixels/(image.width*image.height))
+        image = image.resize((max(1, int(image.width*scale)),
+            max(1, int(image.height*scale))), resample=Image.NEAREST)
+    data = np.array(image).reshape(-1, 4)
+    colors, counts = vp.color_histogram(data)[:2]
+    colors = colors.astype(float)
+
+    results = []
+    for name in names :
+        seconds = np.inf
+        for i in range(repeats) :
+            start_time = time.perf_counter()
+            quantizer = vp.run_quantizer(data=data, quantizer=name, **kwargs)
+            seconds = min(seconds, time.perf_counter()-start_time)
+        # The (0,0,0,0) color added for transparency is not part of the error
+        means = quantizer.means[:quantizer.k]
+        sq_dists = vp.nearest_centers(colors, means)[1]
+        results.append(BenchmarkResult(quantizer=name, seconds=seconds,
+            error=np.dot(sq_dists, counts)/np.sum(counts)))
+    return results
+
+# Time (best of repeats runs, in seconds) of importing each of the modules in
+# a fresh interpreter, as a dict by module name
+def benchmark_imports(**kwargs) :
+    modules = kwargs.get("modules", default_import_modules)
+    repeats = max(1, kwargs.get("repeats", 5))
+    folder = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for module in modules :
+        code = ("import time; t = time.perf_counter(); import "+module+
+            "; print(time.perf_counter()-t)")
+        seconds = np.inf
+        for i in range(repeats) :
+            output = subprocess.run([sys.executable, "-c", code], cwd=folder,
+                capture_output=True, text=True, check=True).stdout
+            seconds = min(seconds, float(output))
+        results[module] = seconds
+    return results
+
+def main(argv=None) :
+    parser = argparse.ArgumentParser(prog="VIMPRO_Benchmark",
+        description="Compare the speed and error of the VIMPRO color "
+        "quantizers on the same input")
+    parser.add_argument("image", nargs="?", help="Input image")
+    parser.add_argument("-k", "--palette-size", type=int, default=4)
+    parser.add_argument("--quantizers", nargs="+", default=default_quantizers)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--max-pixels", type=int, default=None)
+    parser.add_argument("--fidelity", type=int, default=4)
+    parser.add_argument("--refine-iters", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--import-time", action="store_true", help="Measure "
+        "the import latency of the VIMPRO modules instead")
+    args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    if args.import_time :
+        results = benchmark_imports(repeats=args.repeats)
+        print("{:<20} {:>10}".format("Module", "Time [s]"))
+        for module, seconds in results.items() :
+            print("{:<20} {:>10.4f}".format(module, seconds))
+        return 0
+    if args.image is None :
+        parser.error("an input image is required")
+
+    for name in args.quantizers :
+        if not vp.is_quantizer(name) :
+            parser.error("unknown quantizer: "+name)
+    results = benchmark_quantizers(Image.open(args.image),
+        quantizers=args.quantizers, repeats=args.repeats,
+        maxpixels=args.max_pixels, k=args.palette_size,
+        fidelity=args.fidelity, refineiters=args.refine_iters, seed=args.seed)
+    print("{:<20} {:>10} {:>12}".format("Quantizer", "Time [s]", "MSE"))
+    for result in results :
+        print("{:<20} {:>10.4f} {:>12.2f}".format(result.quantizer,
+            result.seconds, result.error))
+    return 0
+
+### MAIN ######################################################################
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,307 @@
+###############################################################################
+##                                                                           ##
+##             ________________________________     _________   _________    ##
+##            // ____  ____  _________________/    // ____  /  // ____  /    ##
+##           // /  // /  // /                     // /  // /  // /  // /     ##
+##          // /  // /  // /_____  _________     // /__// /__//_/__// /      ##
+##         // /  // /  // ______/ // ______/    // __________________/       ##
+##        // /  // /  // /_______//_/_____     // /        // /_____         ##
+##       // /  // /  // _______________  /    // /        //_____  /         ##
+##      // /  // /  // /_____  // /__// /    // /        ___   // /          ##
+##     // /__// /  // ______/ //_______/    // /        // /__// /           ##
+##    //_______/  //_/                     //_/        //_______/            ##
+##                                                                           ##
+##                                                             Stefan Radman ##
+###############################################################################
+
+### IMPORTS ###################################################################
+
+import io
+import os
+import sys
+import argparse
+
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+
+import VIMPRO_Processor as vp
+import VIMPRO_Toolchain as vtc
+
+### DATA ######################################################################
+
+proc_modes = {"default" : "Default", "tiled" : "Tiled"}
+comp_modes = {"default" : "Default", "gbc" : "Game Boy Color"}
+image_extensions = (".png", ".jpg", ".jpeg", ".bmp", ".gif", ".tif", ".tiff",
+    ".webp")
+
+### FUNCTIONS #################################################################
+
+def parse_args(argv) :
+    parser = argparse.ArgumentParser(prog="vimpro",
+        description="VIMPRO - Virmodoetiae Image Processor (batch mode)")
+    parser.add_argument("inputs", nargs="+", help="Input images or "
+        "directories of images, - to read a single image from stdin and "
+        "write the result to stdout")
+    parser.add_argument("-o", "--output-dir", default=None,
+        help="Output directory (defaults to the folder of each input)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+        help="Number of worker processes")
+    parser.add_argument("--threads", type=int, default=1,
+        help="Number of threads used by each worker process for the pixel to "
+        "palette mapping")
+    parser.add_argument("--memory-budget", type=int, default=None,
+        help="Memory budget (in MB) of the pixel to palette mapping")
+    parser.add_argument("--region-processes", type=int, default=1,
+        help="Number of processes running the k-means of the palettes grid "
+        "regions of each image in parallel (Tiled mode)")
+    parser.add_argument("--batched-kmeans", action="store_true",
+        help="Solve the k-means of all the palettes grid regions of each "
+        "image together in one vectorized pass (Tiled mode)")
+    parser.add_argument("--mode", choices=proc_modes.keys(),
+        default="default", help="Processor mode")
+    parser.add_argument("--compat", choices=comp_modes.keys(),
+        default="default", help="Compatibility mode")
+    parser.add_argument("--palette-size", type=int, default=4)
+    parser.add_argument("--palettes-grid", type=int, nargs=2, default=(4, 2),
+        metavar=("X", "Y"), help="Palettes search grid size (Tiled mode)")
+    parser.add_argument("--rgb-bits", type=int, nargs=3, default=None,
+        metavar=("R", "G", "B"), help="Bits per channel (defaults to 16 16 16,"
+        " 5 5 5 in gbc mode)")
+    parser.add_argument("--fidelity", type=int, default=4)
+    parser.add_argument("--quantize-input", action="store_true",
+        help="Snap the input colors to the --rgb-bits grid before the k-means, "
+        "which then clusters all the output pixels")
+    parser.add_argument("--snap-means", action="store_true",
+        help="Snap the k-means means to the --rgb-bits grid at every "
+        "iteration, and stop as soon as the snapped palette stops changing")
+    parser.add_argument("--report-savings", action="store_true",
+        help="Print how many k-means iterations --snap-means saved")
+    parser.add_argument("--tile-size", type=int, nargs=2, default=None,
+        metavar=("X", "Y"), help="Tile size in pixels (Tiled mode, defaults to"
+        " 32 32, 8 8 in gbc mode)")
+    parser.add_argument("--out-size", type=int, nargs=2, default=None,
+        metavar=("X", "Y"), help="Output resolution in pixels (defaults to "
+        "the input resolution, forced to 160x144 in gbc mode)")
+    parser.add_argument("--max-pixels", type=int, default=None,
+        help="Max number of pixels the k-means operates on")
+    parser.add_argument("--quantizer", default="kmeans",
+        help="Color quantizer backend, one of "+", ".join(vp.quantizers)+
+        ", or <backend>+kmeans to refine the palette found by that backend "
+        "with a few k-means iterations")
+    parser.add_argument("--refine-iters", type=int, default=3,
+        help="Number of k-means iterations of <backend>+kmeans quantizers")
+    parser.add_argument("--sampling", default="nearest",
+        choices=["nearest", "coreset", "stratified"], help="How the at most "
+        "--max-pixels colors the k-means runs on are picked: nearest "
+        "downsampling, or a weighted coreset or stratified sample of the "
+        "colors of the whole image")
+    parser.add_argument("--coarse-to-fine", action="store_true",
+        help="Run the k-means on all the output pixels, warm-starting it "
+        "from the means found on successively larger subsamples")
+    parser.add_argument("--coarse-pixels", type=int, default=64*64,
+        help="Number of pixels of the coarsest --coarse-to-fine subsample")
+    parser.add_argument("--kmeans-init", default="kmeans++",
+        choices=["random", "kmeans++", "greedykmeans++"]+[name for name in
+        vp.quantizers if name != "kmeans"],
+        help="k-means means initialization")
+    parser.add_argument("--kmeans-engine", default="lloyd",
+        choices=["lloyd", "hamerly", "minibatch"], 
+        help="k-means iteration engine")
+    parser.add_argument("--batch-size", type=int, default=1024,
+        help="Number of colors sampled at each minibatch k-means iteration")
+    parser.add_argument("--tile-scoring", default="avgnorm",
+        choices=["avgnorm", "minnorm", "sqerror"], help="Tile to palette "
+        "scoring strategy (Tiled mode), sqerror minimizes the actual "
+        "quantization error of each tile")
+    parser.add_argument("--timings", action="store_true",
+        help="Print the time spent in the timed processing steps")
+    parser.add_argument("--seed", type=int, default=None,
+        help="Random seed, for reproducible results")
+    parser.add_argument("--pixel-size", type=int, default=1,
+        help="Size of each output pixel in the saved image")
+    parser.add_argument("--asm", action="store_true", help="Also write the "
+        ".asm source (gbc mode only)")
+    parser.add_argument("--rom", action="store_true", help="Also write the "
+        ".gb ROM (gbc mode only)")
+    parser.add_argument("--assembler", choices=["builtin", "rgbds"],
+        default="builtin", help="How --rom ROMs are built, in process or by "
+        "compiling the .asm sources with RGBDS (a system one on PATH, or the "
+        "embedded one on Windows), at most --jobs at a time")
+    parser.add_argument("--binaries", action="store_true", help="Also write "
+        "the .2bpp, .tilemap, .attrmap and .pal binary files (gbc mode only)")
+    parser.add_argument("--tile-flips", action="store_true", help="Also reuse "
+        "the horizontally and/or vertically flipped versions of repeated "
+        "tiles in the .asm source (gbc mode only)")
+    parser.add_argument("--suffix", default="_VIMPRO",
+        help="Suffix appended to the output file names")
+    return parser.parse_args(argv)
+
+# Build the kwargs for vp.process_image from the parsed arguments and the
+# input image size
+def build_config(args, image_size) :
+    rgb_bits = args.rgb_bits
+    if rgb_bits is None :
+        rgb_bits = (5, 5, 5) if args.compat == "gbc" else (16, 16, 16)
+    tile_size = args.tile_size
+    if tile_size is None :
+        tile_size = (8, 8) if args.compat == "gbc" else (32, 32)
+    config = {
+        "procmode" : proc_modes[args.mode],
+        "compmode" : comp_modes[args.compat],
+        "palettesgridsize" : tuple(args.palettes_grid),
+        "palettesize" : args.palette_size,
+        "rgbbits" : list(rgb_bits),
+        "fidelity" : args.fidelity,
+        "quantizeinput" : args.quantize_input,
+        "snapmeans" : args.snap_means,
+        "reportsavings" : args.report_savings,
+        "tilesize" : tuple(tile_size),
+        "quantizer" : args.quantizer,
+        "refineiters" : args.refine_iters,
+        "sampling" : args.sampling,
+        "coarsetofine" : args.coarse_to_fine,
+        "coarsepixels" : args.coarse_pixels,
+        "kmeansinit" : args.kmeans_init,
+        "kmeansengine" : args.kmeans_engine,
+        "batchsize" : args.batch_size,
+        "tilescoring" : args.tile_scoring,
+        "tileflips" : args.tile_flips,
+        "seed" : args.seed}
+    if args.max_pixels is not None :
+        config["maxpixels"] = args.max_pixels
+    config["threads"] = args.threads
+    config["processes"] = args.region_processes
+    config["batchedkmeans"] = args.batched_kmeans
+    if args.memory_budget is not None :
+        config["memorybudget"] = args.memory_budget*2**20
+    out_size = args.out_size
+    if out_size is None :
+        out_size = image_size
+    if args.compat == "gbc" :
+        out_size = (160, 144)
+    if args.mode == "tiled" :
+        # In Tiled mode, outsize is the tiles grid size
+        out_size = (max(1, int(out_size[0]/tile_size[0])),
+            max(1, int(out_size[1]/tile_size[1])))
+    config["outsize"] = tuple(out_size)
+    return config
+
+def scale_output(image, pixel_size) :
+    if pixel_size == 1 :
+        return image
+    return image.resize((image.width*pixel_size, image.height*pixel_size),
+        resample=Image.NEAREST)
+
+# Worker function, run in a separate process for each input file. Returns the
+# path of the output image and, if its ROM is to be compiled with RGBDS, its 
+# asm source
+def process_file(input_path, output_root, args) :
+    image = Image.open(input_path)
+    result = vp.process_image(image, **build_config(args, image.size))
+    scale_output(result.image, args.pixel_size).save(output_root+".png")
+    if args.asm and result.asm is not None :
+        with open(output_root+".asm", "w") as o :
+            o.write(result.asm)
+    if args.rom and result.rom is not None and args.assembler == "builtin" :
+        with open(output_root+".gb", "wb") as o :
+            o.write(result.rom)
+    if args.binaries and result.binaries is not None :
+        for extension, data in result.binaries.items() :
+            with open(output_root+extension, "wb") as o :
+                o.write(data)
+    if args.timings :
+        for name, seconds in result.timings.items() :
+            print(input_path+":", name, "{:.3f}".format(seconds), "s")
+    if args.report_savings and result.iters_saved is not None :
+        print(input_path+": k-means iterations saved by snapping the means:",
+            result.iters_saved)
+    if args.rom and args.assembler == "rgbds" :
+        return output_root+".png", result.asm
+    return output_root+".png", None
+
+def process_stream(args) :
+    image = Image.open(io.BytesIO(sys.stdin.buffer.read()))
+    result = vp.process_image(image, **build_config(args, image.size))
+    # stdout carries the output, so the report goes to stderr
+    if args.report_savings and result.iters_saved is not None :
+        print("k-means iterations saved by snapping the means:", 
+            result.iters_saved, file=sys.stderr)
+    if args.asm and result.asm is not None :
+        sys.stdout.write(result.asm)
+    elif args.rom and result.rom is not None :
+        if args.assembler == "rgbds" :
+            sys.stdout.buffer.write(vtc.assemble_rom(result.asm))
+        else :
+            sys.stdout.buffer.write(result.rom)
+    else :
+        scale_output(result.image, args.pixel_size).save(sys.stdout.buffer,
+            format="PNG")
+    sys.stdout.flush()
+
+def collect_inputs(inputs) :
+    paths = []
+    for path in inputs :
+        if os.path.isdir(path) :
+            for name in sorted(os.listdir(path)) :
+                if name.lower().endswith(image_extensions) :
+                    paths.append(os.path.join(path, name))
+        else :
+            paths.append(path)
+    return paths
+
+def main(argv=None) :
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+
+    if args.inputs == ["-"] :
+        process_stream(args)
+        return 0
+
+    paths = collect_inputs(args.inputs)
+    if args.output_dir is not None :
+        os.makedirs(args.output_dir, exist_ok=True)
+    output_roots = []
+    for path in paths :
+        folder = args.output_dir
+        if folder is None :
+            folder = os.path.dirname(path)
+        name = os.path.splitext(os.path.basename(path))[0]
+        output_roots.append(os.path.join(folder, name+args.suffix))
+
+    failures = 0
+    sources = {}
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as executor :
+        futures = [executor.submit(process_file, path, root, args)
+            for path, root in zip(paths, output_roots)]
+        for path, root, future in zip(paths, output_roots, futures) :
+            try :
+                output_path, asm = future.result()
+                print(path, "->", output_path)
+                if asm is not None :
+                    sources[path] = (root, asm)
+            except Exception as e :
+                failures += 1
+                print(path, "-> failed:", e, file=sys.stderr)
+
+    # Compile all the ROMs through a pool of at most --jobs RGBDS toolchains
+    if sources :
+        toolchain = vtc.find_toolchain()
+        if toolchain is None :
+            print("Cannot compile .gb files:", vtc.toolchain_error(), 
+                file=sys.stderr)
+            return 1
+        try :
+            roms = vtc.compile_roms([asm for _, asm in sources.values()],
+                jobs=args.jobs, toolchain=toolchain)
+        except Exception as e :
+            print("Compilation failed:", e, file=sys.stderr)
+            return 1
+        for (path, (root, _)), rom in zip(sources.items(), roms) :
+            with open(root+".gb", "wb") as o :
+                o.write(rom)
+            print(path, "->", root+".gb")
+    return 1 if failures else 0
+
+### MAIN ######################################################################
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -17,7 +17,6 @@
 ### IMPORTS ###################################################################
 
 import os
-from sys import platform
 import logging
 import numpy as np
 
@@ -34,6 +33,10 @@ import VIMPRO_Data as vd
 interpolation_modes = {"Bilinear" : Image.BILINEAR, "Bicubic" : Image.BICUBIC,
     "Nearest" : Image.NEAREST, "Lanczos" : Image.LANCZOS}
 
+quantizer_modes = {"K-means" : "kmeans", "Median cut" : "mediancut",
+    "Octree" : "octree", "Wu" : "wu", "Median cut + K-means" : 
+    "mediancut+kmeans", "Wu + K-means" : "wu+kmeans"}
+
 anchor_points = {"Center" : "c", "Top" : "n", "Top-right" : "ne", "Right" : "e", 
     "Bottom-right" : "se", "Bottom" : "s", "Bottom-left" : "sw",
     "Left" : "w", "Top-left" : "nw"}
@@ -121,7 +124,8 @@ class GUI(tk.Tk) :
         "Rotate by",
         "Processing options", "Processor mode", "Compatibility mode", 
         "Palettes search grid size", "Palette size", 
-        "Bits per channel (R,G,B)", "Fidelity", "Tile size", "Tiles grid size",
+        "Bits per channel (R,G,B)", "Fidelity", "Quantizer", "Tile size", 
+        "Tiles grid size",
         "Output resolution", "Process image", "Save & export options", 
         "Pixel size", "Final resolution", "Save image", "Export .asm source",
         "Compile .gb file"]
@@ -389,6 +393,20 @@ class GUI(tk.Tk) :
         self.fidelity_e.grid(row=row_n, column=1, columnspan=3,
             sticky=tk.W+tk.E, **self.pad1.get("e"))
 
+        # Quantizer ------------------#
+        row_name = "Quantizer"
+        row_n = self.ctrl_rows[row_name]
+        quantizer_l = tk.Label(self.ctrl_frame, text=row_name, anchor=tk.W,
+            width=self.label_width)
+        quantizer_l.grid(row=row_n, column=0, sticky=tk.W, 
+            **self.pad1.get("w"))
+
+        self.quantizer_sv = tk.StringVar()
+        self.quantizer_om = ttk.OptionMenu(self.ctrl_frame, self.quantizer_sv,
+            list(quantizer_modes.keys())[0], *quantizer_modes.keys())
+        self.quantizer_om.grid(row=row_n, column=1, columnspan=3,
+            sticky=tk.W+tk.E, **self.pad1.get("e"))
+
         # Tile size ------------------#
         row_name = "Tile size"
         row_n = self.ctrl_rows[row_name]
@@ -496,9 +514,6 @@ class GUI(tk.Tk) :
             text=row_name, command=self.on_compile_gb)
         self.compile_gb_b.grid(row=row_n, column=0, sticky=tk.W+tk.E,
             **self.pad1.get("sw", "xx"))
-        # Currently only available on Windows
-        if platform != "win32" :
-            self.compile_gb_b.config(state=tk.DISABLED)
 
         # Add functionality at the end to avoid potential issues regarding
         # referencing missing variables
@@ -921,7 +936,6 @@ class GUI(tk.Tk) :
             appendstr="_VIMPRO_")
 
     def on_export_asm(self) :
-        self.image_processor.create_asm()
         self.image_processor.export_asm()
 
     def on_compile_gb(self) :
@@ -971,6 +985,7 @@ class GUI(tk.Tk) :
         rgb_bits = [self.bits_R_e.value, self.bits_G_e.value, 
             self.bits_B_e.value]
         fidelity = self.fidelity_e.get()
+        quantizer = quantizer_modes[self.quantizer_sv.get()]
         tile_size = (self.tile_size_e_x.value, self.tile_size_e_y.value)
         out_size = (self.out_res_le.x_e.value, self.out_res_le.y_e.value)
         if proc_mode == self.image_processor.tiled_proc_mode_name :
@@ -980,7 +995,7 @@ class GUI(tk.Tk) :
         # Run processor
         self.image_processor.process(palettesgridsize=palettes_grid_size, 
             palettesize=palette_size, rgbbits=rgb_bits, fidelity=fidelity, 
-            tilesize=tile_size, outsize=out_size)
+            quantizer=quantizer, tilesize=tile_size, outsize=out_size)
 
         # Update output resolution of the possible save file
         self.update_save_resolution()
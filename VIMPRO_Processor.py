@@ -18,63 +18,189 @@
 
 import os
 import time
-import random
-import string
-import subprocess
 
-from sys import platform
-from copy import deepcopy
-from PIL import Image, ImageOps, ImageTk
-from tkinter.filedialog import askopenfile, asksaveasfile
+from collections import namedtuple
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from PIL import Image, ImageOps
+
+# tkinter is only imported where file dialogs are actually needed, so that
+# this module can also be used headless (e.g. by VIMPRO_CLI)
 
 import numpy as np
 
 import VIMPRO_Data as vd
+import VIMPRO_Toolchain as vtc
+
+### DATA ######################################################################
+
+# Default memory budget (in bytes) for the temporary arrays of the pixel to
+# palette (or to k-means means) mapping, and default number of threads it is
+# split across
+memory_budget = 2**28
+n_threads = os.cpu_count() or 1
 
 ### CLASSES ###################################################################
 
-class KMeans :
+class Quantizer :
 
-    def __init__(self, **kwargs) :
+    # Common base of the color quantizer backends (see quantizers). Each 
+    # backend works on the weighted color histogram of kwargs["data"] (or on
+    # an already computed (colors, counts) kwargs["histogram"], e.g. when it
+    # is used to seed another backend) and sets self.means to the k colors of
+    # the palette. Single pass backends only need to implement find_means, 
+    # which returns at most k means given self.data and self.data_freq
 
-        # Remove transparency from the k-means clustering and add it back
-        # as a single color (0,0,0,0) to the means if any transparency was
-        # present to begin with
-        tmp = deepcopy(kwargs["data"])
-        alpha_threshold = 127
-        transparent = np.where(tmp[:,3] < alpha_threshold)
-        non_transparent = np.where(tmp[:,3] > alpha_threshold)
-        tmp[non_transparent, 3] = 255
-        tmp[transparent] = np.array([0,0,0,0])
-        tmp = np.delete(tmp, transparent, axis=0)
-        self.has_transparency = False
-        if transparent[0].shape[0] != 0 :
-            self.has_transparency = True
-
-        self.data, self.data_freq = np.unique(tmp, axis=0, 
-            return_counts=True)
-        
+    def __init__(self, **kwargs) :
+        self.load_data(**kwargs)
+        self.means = np.empty((0, self.d))
+        self.iters = 1
+        self.inertia = None
+        self.mapping_kwargs = {
+            "memorybudget" : kwargs.get("memorybudget", memory_budget),
+            "threads" : kwargs.get("threads", n_threads)}
+        self.print_info = kwargs.get("printinfo", False)
+        if kwargs.get("autorun", True) :
+            self.run()
+
+    def load_data(self, **kwargs) :
+        # Remove transparency from the clustering and add it back as a single
+        # color (0,0,0,0) to the means if any transparency was present to
+        # begin with. The rows of data can be weighted by kwargs["weights"]
+        # (e.g. for a coreset, see sample_colors), in which case transparency
+        # tells whether the data they were sampled from had any transparency
+        if "histogram" in kwargs :
+            self.data, self.data_freq = kwargs["histogram"]
+            self.has_transparency = False
+        else :
+            self.data, self.data_freq, self.has_transparency = \
+                color_histogram(kwargs["data"], 
+                weights=kwargs.get("weights", None))
+        self.has_transparency |= kwargs.get("transparency", False)
+
+        # If quantize is True, the colors are snapped to the rgbbits grid
+        # before clustering (so that there are at most as many weighted points
+        # as colors in that grid, e.g. 32768 for 5 bits per channel)
+        self.rgb_bits = kwargs.get("rgbbits", [16, 16, 16])
+        self.quantize = kwargs.get("quantize", False)
+        if self.quantize :
+            self.data, self.data_freq = quantize_histogram(self.data, 
+                self.data_freq, self.rgb_bits)
+        self.data = self.data.astype(float)
         self.n = self.data.shape[0]
         self.d = self.data.shape[1]
         self.k = kwargs["k"]
+
+    def run(self) :
+        if self.n <= self.k :
+            self.means = self.data
+        else :
+            self.means = self.find_means()
+            self.inertia = np.dot(nearest_centers(self.data, self.means, 
+                **self.mapping_kwargs)[1], self.data_freq)
+            if self.print_info :
+                print("Final", type(self).__name__, "inertia:", 
+                    '{:.3E}'.format(self.inertia))
+        self.finalize()
+
+    def find_means(self) :
+        raise NotImplementedError
+
+    def force_means_size(self) :
+        # Force size of k on self.means. The means as they were before are
+        # kept in self.raw_means (e.g. to warm-start another k-means)
+        self.raw_means = self.means
+        self.means = np.unique(np.rint(self.means), axis=0)
+        while self.means.shape[0] < self.k :
+            self.means = np.vstack([self.means, self.means[-1]])
+
+    def finalize(self) :
+        self.force_means_size()
+
+        if self.has_transparency :
+            self.means = np.vstack([self.means, np.array([0,0,0,0])])
+
+    # Weighted means of the data points, grouped by labels (0 to n_labels-1)
+    def labels_means(self, labels, n_labels) :
+        weights = np.bincount(labels, weights=self.data_freq, 
+            minlength=n_labels)
+        means = np.empty((n_labels, self.d))
+        for j in range(self.d) :
+            means[:,j] = np.bincount(labels, weights=self.data_freq*
+                self.data[:,j], minlength=n_labels)
+        return means[weights > 0]/weights[weights > 0][:,None]
+
+#-----------------------------------------------------------------------------#
+
+class KMeans(Quantizer) :
+
+    def __init__(self, **kwargs) :
+
+        # See Quantizer.load_data. If quantize is True, the means are also 
+        # snapped to the rgbbits grid after each update
+        self.load_data(**kwargs)
+
+        # If snapmeans is True, the means are snapped to the rgbbits grid 
+        # after each update (as when quantize is True, but the data is left
+        # untouched), and the iterations also stop as soon as the snapped 
+        # means, i.e. the final palette, stop changing. If reportsavings is
+        # True, the same k-means is also run without snapping, to report how
+        # many iterations that saved (in self.iters_saved)
+        self.snap_means = self.quantize or kwargs.get("snapmeans", False)
+        self.iters_saved = None
+        self.unsnapped_kwargs = None
+        if kwargs.get("reportsavings", False) and self.snap_means :
+            self.unsnapped_kwargs = dict(kwargs, quantize=False, 
+                snapmeans=False, reportsavings=False, printinfo=False, 
+                autorun=True)
         
         self.means = np.empty((0, self.d))
-        self.clusters = []
-        self.weights = []
+        self.iters = 0
+        self.inertia = None
         
         self.max_iters = kwargs.get("maxiters", 200)
         self.min_rel_epsilon = (1.0/3.0)**(kwargs.get("fidelity", 10)-1)
+
+        # Means initialization, either "random", "kmeans++", "greedykmeans++",
+        # the name of another backend in quantizers or an array of means to
+        # start from. The seed (anything accepted by 
+        # np.random.default_rng) makes the initialization, and thus the whole 
+        # run, reproducible
+        self.init = kwargs.get("init", "kmeans++")
+        self.rng = np.random.default_rng(kwargs.get("seed", None))
+
+        # Iteration engine, either "lloyd" (i.e. brute force, computes all
+        # point-mean distances at every iteration) or "hamerly". The latter
+        # keeps, for each point, an upper bound on the distance from its mean
+        # and a lower bound on the distance from the second closest mean, and
+        # only computes the distances of the points whose bounds do not 
+        # prove that their assignment cannot change. Both produce the same 
+        # assignments, and thus the same means. A third engine, "minibatch",
+        # only assigns a batch of batchsize points (sampled according to 
+        # data_freq) at each iteration, and moves each mean towards the batch
+        # points assigned to it with a learning rate that decreases with the
+        # number of points it has been assigned so far. Its iterations thus 
+        # cost the same regardless of the number of colors, and a single 
+        # full assignment is done at the end
+        self.engine = kwargs.get("engine", "lloyd")
+        self.batch_size = kwargs.get("batchsize", 1024)
+        self.counts = None
+        self.cum_freq = None
+        self.mapping_kwargs = {
+            "memorybudget" : kwargs.get("memorybudget", memory_budget),
+            "threads" : kwargs.get("threads", n_threads)}
+        self.labels = None
+        self.upper = None
+        self.lower = None
+        self.drift = None
         
         self.print_info = kwargs.get("printinfo", False)
         
-        self.run()
+        # autorun is False only when the iterations are driven from outside
+        # (see BatchedKMeans)
+        if kwargs.get("autorun", True) :
+            self.run()
 
-    def force_means_size(self) :
-        # Force size of k on self.means
-        self.means = np.unique(np.rint(self.means), axis=0)
-        while self.means.shape[0] < self.k :
-            self.means = np.vstack([self.means, self.means[-1]])
-        
     def run(self) :
         # Do nothing if data smaller than k
         if self.n <= self.k :
@@ -86,70 +212,264 @@ class KMeans :
             print("Running k-means with target residual:", 
                 '{:.3E}'.format(self.min_rel_epsilon))
 
-        # Initialize means randomly
-        while self.means.shape[0] < self.k :
-            self.means = np.vstack([self.means, self.sample_from_data()])
+        self.init_means()
         
-        # Run the k-means iterations
+        # Run the k-means iterations. Convergence is measured on the weighted
+        # inertia, i.e. the iterations stop when its decrease, relative to 
+        # the first decrease, falls below the target residual
         i = 0
         not_converged = True
         rel_epsilon = 1.0
-        start_epsilon = 0.0
+        start_delta = None
         while (i < self.max_iters and not_converged) :
-            epsilon = self.run_one_iteration()
-            if i == 0 :
-                start_epsilon = epsilon
-            else :
-                rel_epsilon = epsilon/start_epsilon
+            means = self.means
+            inertia = self.run_one_iteration()
+            if self.engine == "minibatch" and i > 0 :
+                # Batch inertias are too noisy to be compared, so convergence
+                # is measured on the (squared) drift of the means instead, 
+                # relative to the first one after the initialization
+                delta = np.sum(np.square(self.drift))
+                if start_delta is None :
+                    start_delta = delta
+                rel_epsilon = delta/start_delta if start_delta > 0 else 0.0
+            elif self.engine != "minibatch" and i > 0 :
+                delta = self.inertia-inertia
+                if start_delta is None :
+                    start_delta = delta
+                rel_epsilon = delta/start_delta if start_delta > 0 else 0.0
+            self.inertia = inertia
             if rel_epsilon <= self.min_rel_epsilon :
                 not_converged = False
+            # Unchanged snapped means also imply unchanged assignments from
+            # now on, so nothing else can change
+            if self.snap_means and np.array_equal(means, self.means) :
+                not_converged = False
             i+=1
+        self.iters = i
 
-        self.force_means_size()
+        if self.engine == "minibatch" :
+            self.assign_all()
 
-        if self.has_transparency :
-            self.means = np.vstack([self.means, np.array([0,0,0,0])])
+        self.finalize()
 
         if self.print_info :
-            print("Final k-means performance (iters/res):", i,
-                '{:.3E}'.format(rel_epsilon))
+            print("Final k-means performance (iters/res/inertia):", i,
+                '{:.3E}'.format(rel_epsilon), '{:.3E}'.format(self.inertia))
 
-    def run_one_iteration(self) :
+        self.report_savings()
 
-        # This bit of code produces an array dists of shape
-        # (data.shape[0], means.shape[1]). Each row contains the
-        # distances of the corresponding data point to each point
-        # in means. So dists[i][j] is the average distance of data[i]
-        # form means[j]
-        dists = np.sum(np.square(self.data[:,None,:]-self.means[None,:,:]), 
-            axis=2)
+    def report_savings(self) :
+        if self.unsnapped_kwargs is None :
+            return
+        self.iters_saved = KMeans(**self.unsnapped_kwargs).iters-self.iters
+        if self.print_info :
+            print("k-means iterations saved by snapping the means:", 
+                self.iters_saved, "(out of", self.iters+self.iters_saved, 
+                "without snapping)")
+
+    def init_means(self) :
+        # Warm start from the means passed as init (e.g. the raw_means of a
+        # previous run, see coarse_to_fine_kmeans)
+        if isinstance(self.init, np.ndarray) :
+            self.means = np.array(self.init[:self.k], dtype=float)
+            while self.means.shape[0] < self.k :
+                self.means = np.vstack([self.means, self.sample_from_data()])
+            return
 
-        # Assign points in data to the closest cluster corresponding to 
-        # each mean
-        argmin_dists = np.argmin(dists, axis=1)
-        self.clusters = [[] for i in range(self.k)]
-        self.weights = [[] for i in range(self.k)]
-        for i, mean in enumerate(self.means) :
-            indices = np.where(argmin_dists == i)[0]
-            self.clusters[i] = self.data[indices]
-            self.weights[i] = self.data_freq[indices]
-        
-        # Update means
-        epsilon = 0
-        for i, cluster in enumerate(self.clusters) :
-            if cluster.shape[0] > 0 :
-                new_mean = np.average(cluster, 
-                    axis=0, weights=np.asarray(self.weights[i]))
-            else :
-                new_mean = self.sample_from_data()
-            epsilon += np.linalg.norm(new_mean-self.means[i])
-            self.means[i] = new_mean
+        if self.init == "random" :
+            while self.means.shape[0] < self.k :
+                self.means = np.vstack([self.means, self.sample_from_data()])
+            return
 
-        return epsilon
+        # Seeding from the means found by another backend (e.g. "mediancut"),
+        # so that the k-means only refines them. If that backend finds fewer
+        # than k means, the missing ones are sampled at random
+        if self.init in quantizers and quantizers[self.init] is not KMeans :
+            self.means = quantizers[self.init](histogram=(self.data, 
+                self.data_freq), k=self.k, autorun=False, 
+                **self.mapping_kwargs).find_means()
+            while self.means.shape[0] < self.k :
+                self.means = np.vstack([self.means, self.sample_from_data()])
+            return
+
+        # k-means++ seeding on the weighted color histogram, i.e. each new 
+        # mean is sampled with a probability proportional to data_freq times
+        # the squared distance from the closest mean picked so far. The greedy
+        # variant draws several candidates at each step and keeps the one that
+        # reduces the total (weighted) potential the most
+        n_trials = 1
+        if self.init == "greedykmeans++" :
+            n_trials = 2+int(np.log(self.k))
+        weights = self.data_freq/np.sum(self.data_freq)
+        first = self.rng.choice(self.n, p=weights)
+        means = [self.data[first]]
+        closest = centers_distances(self.data, self.data[first][None,:], 
+            **self.mapping_kwargs)[0]
+        for i in range(1, self.k) :
+            potential = closest*self.data_freq
+            candidates = self.rng.choice(self.n, size=n_trials, 
+                p=potential/np.sum(potential))
+            candidates_closest = np.minimum(closest[None,:], centers_distances(
+                self.data, self.data[candidates], **self.mapping_kwargs))
+            best = np.argmin(np.dot(candidates_closest, self.data_freq))
+            closest = candidates_closest[best]
+            means.append(self.data[candidates[best]])
+        self.means = np.array(means)
+
+    def run_one_iteration(self) :
+
+        if self.engine == "minibatch" :
+            return self.run_one_minibatch_iteration()
+
+        if self.engine == "hamerly" :
+            argmin_dists = self.assign_hamerly()
+            min_dists = np.sum(np.square(
+                self.data-self.means[argmin_dists]), axis=1)
+        else :
+            # Assign points in data to the closest cluster corresponding to 
+            # each mean (see nearest_centers for how the distances are
+            # computed in bounded memory)
+            argmin_dists, min_dists = nearest_centers(self.data, self.means,
+                **self.mapping_kwargs)
+        self.labels = argmin_dists
+
+        # Weighted sum of squared distances of the points from their means
+        inertia = np.dot(min_dists, self.data_freq)
+
+        # Update means, all clusters at once via weighted bincounts
+        cluster_weights = np.bincount(argmin_dists, weights=self.data_freq, 
+            minlength=self.k)
+        new_means = np.empty((self.k, self.d))
+        for j in range(self.d) :
+            new_means[:,j] = np.bincount(argmin_dists, 
+                weights=self.data_freq*self.data[:,j], minlength=self.k)
+        non_empty = cluster_weights > 0
+        new_means[non_empty] /= cluster_weights[non_empty][:,None]
+
+        # Empty clusters are all re-seeded at once on the points that are the
+        # farthest from their means (which are distinct and not means already)
+        empty = np.where(~non_empty)[0]
+        if empty.shape[0] > 0 :
+            farthest = np.argpartition(min_dists, -empty.shape[0])[
+                -empty.shape[0]:]
+            new_means[empty] = self.data[farthest]
+
+        if self.snap_means :
+            new_means = snap_colors(new_means, self.rgb_bits)
+
+        self.drift = np.sqrt(np.sum(np.square(new_means-self.means), axis=1))
+        self.means = new_means
+
+        if self.engine == "hamerly" :
+            self.update_bounds_hamerly()
+
+        return inertia
+
+    def run_one_minibatch_iteration(self) :
+        if self.counts is None :
+            self.counts = np.zeros(self.k)
+            self.cum_freq = np.cumsum(self.data_freq)
+        batch = self.data[np.minimum(np.searchsorted(self.cum_freq, 
+            self.rng.random(self.batch_size)*self.cum_freq[-1], side="right"),
+            self.n-1)]
+        labels, min_dists = nearest_centers(batch, self.means, 
+            **self.mapping_kwargs)
+
+        # Moving each mean by a learning rate of 1/count towards each of its
+        # batch points in turn is the same as moving it towards their sum, 
+        # all at once, with these per-mean rates
+        batch_counts = np.bincount(labels, minlength=self.k)
+        batch_sums = np.empty((self.k, self.d))
+        for j in range(self.d) :
+            batch_sums[:,j] = np.bincount(labels, weights=batch[:,j], 
+                minlength=self.k)
+        self.counts += batch_counts
+        moved = batch_counts > 0
+        new_means = self.means.copy()
+        new_means[moved] += (batch_sums[moved]-batch_counts[moved][:,None]*
+            self.means[moved])/self.counts[moved][:,None]
+
+        if self.snap_means :
+            new_means = snap_colors(new_means, self.rgb_bits)
+
+        self.drift = np.sqrt(np.sum(np.square(new_means-self.means), axis=1))
+        self.means = new_means
+
+        # Estimate of the weighted inertia from the batch
+        return np.mean(min_dists)*np.sum(self.data_freq)
+
+    def assign_all(self) :
+        self.labels, min_dists = nearest_centers(self.data, self.means,
+            **self.mapping_kwargs)
+        self.inertia = np.dot(min_dists, self.data_freq)
+
+    # Per-cluster copies of the data and of the weights, only materialized on
+    # request
+    @property
+    def clusters(self) :
+        if self.labels is None :
+            return []
+        return [self.data[self.labels == i] for i in range(self.k)]
+
+    @property
+    def weights(self) :
+        if self.labels is None :
+            return []
+        return [self.data_freq[self.labels == i] for i in range(self.k)]
+
+    def assign_hamerly(self) :
+        # First iteration, compute all distances to initialize the bounds
+        if self.labels is None :
+            self.labels = np.zeros(self.n, dtype=np.intp)
+            self.upper = np.zeros(self.n)
+            self.lower = np.zeros(self.n)
+            self.assign_hamerly_subset(np.arange(self.n))
+            return self.labels
+
+        # Half the distance of each mean from its closest other mean. A point
+        # whose upper bound is below that (or below its lower bound) cannot
+        # change cluster
+        means_dists = np.sqrt(np.sum(np.square(
+            self.means[:,None,:]-self.means[None,:,:]), axis=2))
+        np.fill_diagonal(means_dists, np.inf)
+        half_min_dists = 0.5*np.min(means_dists, axis=1)
+        bound = np.maximum(half_min_dists[self.labels], self.lower)
+        candidates = np.where(self.upper > bound)[0]
+
+        # Tighten the upper bound of the candidates and re-check
+        self.upper[candidates] = np.sqrt(np.sum(np.square(
+            self.data[candidates]-self.means[self.labels[candidates]]), 
+            axis=1))
+        candidates = candidates[self.upper[candidates] > bound[candidates]]
+
+        # Only the remaining candidates need all distances to be computed
+        self.assign_hamerly_subset(candidates)
+        return self.labels
+
+    def assign_hamerly_subset(self, indices) :
+        if indices.shape[0] == 0 :
+            return
+        labels, min_dists, second_min_dists = nearest_centers(
+            self.data[indices], self.means, secondnearest=True, 
+            **self.mapping_kwargs)
+        self.labels[indices] = labels
+        self.upper[indices] = np.sqrt(min_dists)
+        self.lower[indices] = np.sqrt(second_min_dists)
+
+    def update_bounds_hamerly(self) :
+        # The upper bounds grow by the drift of the assigned mean, the lower
+        # bounds shrink by the largest drift among the other means
+        self.upper += self.drift[self.labels]
+        if self.k < 2 :
+            return
+        order = np.argsort(self.drift)
+        max_drift = np.where(self.labels == order[-1], 
+            self.drift[order[-2]], self.drift[order[-1]])
+        self.lower -= max_drift
 
     def sample_from_data(self) :
         while True :
-            new_mean = self.data[np.random.randint(0, self.n)]
+            new_mean = self.data[self.rng.integers(0, self.n)]
             
             # I.e. "if new_mean not in self.means"
             if not np.any(np.all((new_mean == self.means), axis=1)) :
@@ -157,11 +477,389 @@ class KMeans :
 
 #-----------------------------------------------------------------------------#
 
+class BatchedKMeans :
+
+    # Runs G independent k-means problems (e.g. the regions of the palettes
+    # grid in process_tiled) together. The datasets are padded (with zero 
+    # weights) to the size of the largest one, and each iteration is run on 
+    # all the problems that have not converged yet at once, as (G, N, K) array
+    # operations, so that there is no per-problem Python overhead. The 
+    # per-problem data, seeding and final means are handled by KMeans objects
+    # that are not run on their own, so that the results are the same as 
+    # running a (Lloyd) KMeans on each dataset with the same seed
+
+    def __init__(self, **kwargs) :
+        datasets = kwargs.pop("datasets")
+        seeds = kwargs.pop("seeds", [None for data in datasets])
+        kwargs["autorun"] = False
+        self.problems = [KMeans(data=data, seed=seed, **kwargs) 
+            for data, seed in zip(datasets, seeds)]
+        self.k = kwargs["k"]
+        self.max_iters = kwargs.get("maxiters", 200)
+        self.min_rel_epsilon = (1.0/3.0)**(kwargs.get("fidelity", 10)-1)
+        self.rgb_bits = kwargs.get("rgbbits", [16, 16, 16])
+        self.snap_means = (kwargs.get("quantize", False) or 
+            kwargs.get("snapmeans", False))
+        self.memory_budget = kwargs.get("memorybudget", memory_budget)
+        self.run()
+
+    @property
+    def means(self) :
+        return [problem.means for problem in self.problems]
+
+    def run(self) :
+        # Problems with no more data than k are trivially solved on their own
+        problems = []
+        for problem in self.problems :
+            if problem.n <= self.k :
+                problem.run()
+            else :
+                problem.init_means()
+                problems.append(problem)
+        if not problems :
+            return
+
+        n_problems = len(problems)
+        sizes = np.array([problem.n for problem in problems])
+        d = problems[0].d
+        data = np.zeros((n_problems, np.max(sizes), d))
+        weights = np.zeros((n_problems, np.max(sizes)))
+        for g, problem in enumerate(problems) :
+            data[g,:problem.n] = problem.data
+            weights[g,:problem.n] = problem.data_freq
+        means = np.array([problem.means for problem in problems])
+
+        # Same convergence criterion as KMeans.run, tracked per problem
+        iters = np.zeros(n_problems, dtype=int)
+        inertia = np.zeros(n_problems)
+        start_delta = np.full(n_problems, np.nan)
+        active = np.arange(n_problems)
+        while active.shape[0] > 0 :
+            new_inertia, new_means = self.run_one_iteration(
+                data[active], weights[active], means[active], sizes[active])
+            unchanged = np.all(new_means == means[active], axis=(1,2))
+            means[active] = new_means
+            first = iters[active] == 0
+            delta = inertia[active]-new_inertia
+            unset = ~first & np.isnan(start_delta[active])
+            start_delta[active[unset]] = delta[unset]
+            with np.errstate(divide="ignore", invalid="ignore") :
+                rel_epsilon = np.where(first, 1.0, np.where(
+                    start_delta[active] > 0, delta/start_delta[active], 0.0))
+            inertia[active] = new_inertia
+            iters[active] += 1
+            converged = ((rel_epsilon <= self.min_rel_epsilon) | 
+                (iters[active] >= self.max_iters))
+            if self.snap_means :
+                converged |= unchanged
+            active = active[~converged]
+
+        for g, problem in enumerate(problems) :
+            problem.means = means[g]
+            problem.iters = iters[g]
+            problem.inertia = inertia[g]
+            problem.finalize()
+            problem.report_savings()
+
+    def run_one_iteration(self, data, weights, means, sizes) :
+        n_problems, n, d = data.shape
+
+        # Nearest mean of all points and squared distance from it, (G, N). 
+        # The (G, N, K) distances are computed in chunks of whole problems,
+        # or of the rows of a single problem if it is too large, so that the
+        # distances and the differences of each chunk fit in memorybudget
+        labels = np.empty((n_problems, n), dtype=np.intp)
+        min_dists = np.empty((n_problems, n))
+        chunk_rows = max(1, int(self.memory_budget/(8*3*self.k)))
+        chunk_problems = max(1, chunk_rows//n)
+        chunk_rows = min(chunk_rows, n)
+        for g_start in range(0, n_problems, chunk_problems) :
+            g_end = min(g_start+chunk_problems, n_problems)
+            for start in range(0, n, chunk_rows) :
+                end = min(start+chunk_rows, n)
+                dists = np.zeros((g_end-g_start, end-start, self.k))
+                for j in range(d) :
+                    dists += np.square(data[g_start:g_end,start:end,None,j]-
+                        means[g_start:g_end,None,:,j])
+                chunk_labels = np.argmin(dists, axis=2)
+                labels[g_start:g_end,start:end] = chunk_labels
+                min_dists[g_start:g_end,start:end] = np.take_along_axis(
+                    dists, chunk_labels[:,:,None], axis=2)[:,:,0]
+        inertia = np.sum(min_dists*weights, axis=1)
+
+        # Update means of all problems at once via weighted bincounts, the
+        # labels of problem g being offset by g*k
+        labels = (labels+np.arange(n_problems)[:,None]*self.k).reshape(-1)
+        cluster_weights = np.bincount(labels, weights=weights.reshape(-1),
+            minlength=n_problems*self.k).reshape(n_problems, self.k)
+        new_means = np.empty((n_problems, self.k, d))
+        for j in range(d) :
+            new_means[:,:,j] = np.bincount(labels, 
+                weights=(weights*data[:,:,j]).reshape(-1), 
+                minlength=n_problems*self.k).reshape(n_problems, self.k)
+        non_empty = cluster_weights > 0
+        new_means[non_empty] /= cluster_weights[non_empty][:,None]
+
+        # Re-seed empty clusters as in KMeans.run_one_iteration
+        for g in np.where(~np.all(non_empty, axis=1))[0] :
+            empty = np.where(~non_empty[g])[0]
+            farthest = np.argpartition(min_dists[g,:sizes[g]], 
+                -empty.shape[0])[-empty.shape[0]:]
+            new_means[g,empty] = data[g,farthest]
+
+        if self.snap_means :
+            new_means = snap_colors(new_means, self.rgb_bits)
+
+        return inertia, new_means
+
+#-----------------------------------------------------------------------------#
+
+class MedianCut(Quantizer) :
+
+    # Recursively split the box of colors with the largest (weighted) sum of
+    # squared deviations from its mean, along its longest channel, at the 
+    # weighted median, until there are k boxes. The means are the weighted 
+    # means of the boxes
+
+    def find_means(self) :
+        boxes = [np.arange(self.n)]
+        errors = [self.box_error(boxes[0])]
+        while len(boxes) < self.k :
+            i = int(np.argmax(errors))
+            if errors[i] <= 0 :
+                break
+            box = boxes[i]
+            data = self.data[box]
+            channel = int(np.argmax(np.max(data, axis=0)-np.min(data, axis=0)))
+            values = data[:,channel]
+            order = np.argsort(values, kind="stable")
+            cum_weights = np.cumsum(self.data_freq[box][order])
+            median = values[order[np.searchsorted(cum_weights, 
+                cum_weights[-1]/2)]]
+            # Both halves must be non-empty
+            lower = values <= median
+            if np.all(lower) :
+                lower = values < median
+            boxes[i] = box[lower]
+            errors[i] = self.box_error(boxes[i])
+            boxes.append(box[~lower])
+            errors.append(self.box_error(boxes[-1]))
+        labels = np.empty(self.n, dtype=np.intp)
+        for i, box in enumerate(boxes) :
+            labels[box] = i
+        return self.labels_means(labels, len(boxes))
+
+    def box_error(self, box) :
+        data = self.data[box]
+        weights = self.data_freq[box]
+        mean = np.dot(weights, data)/np.sum(weights)
+        return np.dot(weights, np.sum(np.square(data-mean), axis=1))
+
+#-----------------------------------------------------------------------------#
+
+class Octree(Quantizer) :
+
+    # Colors are the leaves of a tree whose nodes at depth l are the colors
+    # truncated to their l most significant bits per channel (i.e. an octree
+    # for RGB, here extended to all channels). The tree is cut at the deepest
+    # level with at most k nodes, then the most populated nodes of that level
+    # are split into their children for as long as the total stays within k,
+    # and the most populated children of the next node take up any room that
+    # is left. The means are the weighted means of the resulting nodes
+
+    def find_means(self) :
+        data = self.data.astype(np.int64)
+        labels = np.zeros(self.n, dtype=np.intp)
+        n_labels = 1
+        for level in range(1, 9) :
+            child_labels, n_children = self.level_labels(data, level)
+            if n_children > self.k :
+                break
+            labels, n_labels = child_labels, n_children
+        else :
+            return self.labels_means(labels, n_labels)
+
+        # Children count and weight of each node of the current level
+        parents = np.zeros(n_children, dtype=np.intp)
+        parents[child_labels] = labels
+        children_counts = np.bincount(parents, minlength=n_labels)
+        node_weights = np.bincount(labels, weights=self.data_freq, 
+            minlength=n_labels)
+        order = np.argsort(-node_weights, kind="stable")
+        extra_leaves = np.cumsum(children_counts[order]-1)
+        fits = extra_leaves <= self.k-n_labels
+        split = np.zeros(n_children, dtype=bool)
+        split[np.isin(parents, order[fits])] = True
+        n_split = np.sum(fits)
+        free = self.k-n_labels-(extra_leaves[n_split-1] if n_split > 0 else 0)
+        if free > 0 and n_split < n_labels :
+            children = np.where(parents == order[n_split])[0]
+            children_weights = np.bincount(child_labels, 
+                weights=self.data_freq, minlength=n_children)[children]
+            split[children[np.argsort(-children_weights, 
+                kind="stable")[:free]]] = True
+        labels = np.where(split[child_labels], n_labels+child_labels, labels)
+        labels = np.unique(labels, return_inverse=True)[1].reshape(-1)
+        return self.labels_means(labels, int(np.max(labels))+1)
+
+    def level_labels(self, data, level) :
+        keys = np.zeros(self.n, dtype=np.int64)
+        for j in range(self.d) :
+            keys = (keys << level) | (data[:,j] >> (8-level))
+        keys, labels = np.unique(keys, return_inverse=True)
+        return labels.reshape(-1), keys.shape[0]
+
+#-----------------------------------------------------------------------------#
+
+class Wu(Quantizer) :
+
+    # Xiaolin Wu's quantizer. Colors are binned on a 32x32x32 (R, G, B) grid,
+    # whose cumulative moments (weight, weighted sums of each channel and of
+    # the squared norms) give the statistics of any box of bins in constant
+    # time. The box with the largest variance is then repeatedly cut, along
+    # the channel and at the position that maximize the variance reduction,
+    # until there are k boxes. The means are the weighted means of the boxes
+
+    size = 33
+
+    def find_means(self) :
+        bins = (self.data[:,:3].astype(np.intp) >> 3)+1
+        self.flat_bins = (bins[:,0]*self.size+bins[:,1])*self.size+bins[:,2]
+        self.wt = self.moment(self.data_freq)
+        self.m = [self.moment(self.data_freq*self.data[:,j]) 
+            for j in range(self.d)]
+        self.m2 = self.moment(self.data_freq*np.sum(np.square(self.data), 
+            axis=1))
+
+        # Boxes are (r0, r1, g0, g1, b0, b1), i.e. bins r0 < r <= r1 and so on
+        boxes = [[0, self.size-1, 0, self.size-1, 0, self.size-1]]
+        variances = [self.variance(boxes[0])]
+        while len(boxes) < self.k :
+            i = int(np.argmax(variances))
+            if variances[i] <= 0 :
+                break
+            cut = self.cut(boxes[i])
+            if cut is None :
+                variances[i] = 0.0
+                continue
+            boxes[i], box = cut
+            variances[i] = self.variance(boxes[i])
+            boxes.append(box)
+            variances.append(self.variance(box))
+        boxes = np.array(boxes)
+        weights = self.volume(self.wt, boxes.T)
+        means = np.stack([self.volume(m, boxes.T) for m in self.m], axis=1)
+        return means[weights > 0]/weights[weights > 0][:,None]
+
+    def moment(self, weights) :
+        moment = np.bincount(self.flat_bins, weights=weights, 
+            minlength=self.size**3).reshape(self.size, self.size, self.size)
+        return np.cumsum(np.cumsum(np.cumsum(moment, axis=0), axis=1), axis=2)
+
+    # Sum of the moment over the box(es) (r0, r1, g0, g1, b0, b1), whose 
+    # bounds may also be arrays
+    def volume(self, moment, box) :
+        r0, r1, g0, g1, b0, b1 = box
+        return (moment[r1,g1,b1]-moment[r1,g1,b0]-moment[r1,g0,b1]+
+            moment[r1,g0,b0]-moment[r0,g1,b1]+moment[r0,g1,b0]+
+            moment[r0,g0,b1]-moment[r0,g0,b0])
+
+    def variance(self, box) :
+        weight = self.volume(self.wt, box)
+        if weight <= 0 :
+            return 0.0
+        return self.volume(self.m2, box)-sum(np.square(self.volume(m, box)) 
+            for m in self.m)/weight
+
+    def cut(self, box) :
+        total_weight = self.volume(self.wt, box)
+        totals = [self.volume(m, box) for m in self.m]
+        best = None
+        best_score = -np.inf
+        for axis in range(3) :
+            lo, hi = box[2*axis], box[2*axis+1]
+            if hi-lo < 2 :
+                continue
+            positions = np.arange(lo+1, hi)
+            lower_box = list(box)
+            lower_box[2*axis+1] = positions
+            weights = self.volume(self.wt, lower_box)
+            valid = (weights > 0) & (weights < total_weight)
+            if not np.any(valid) :
+                continue
+            sums = [self.volume(m, lower_box) for m in self.m]
+            with np.errstate(divide="ignore", invalid="ignore") :
+                scores = (sum(np.square(x) for x in sums)/weights+
+                    sum(np.square(t-x) for t, x in zip(totals, sums))/
+                    (total_weight-weights))
+            scores[~valid] = -np.inf
+            j = int(np.argmax(scores))
+            if scores[j] > best_score :
+                best_score = scores[j]
+                best = (axis, int(positions[j]))
+        if best is None :
+            return None
+        axis, position = best
+        lower_box, upper_box = list(box), list(box)
+        lower_box[2*axis+1] = position
+        upper_box[2*axis] = position
+        return lower_box, upper_box
+
+#-----------------------------------------------------------------------------#
+
+class PaletteIndexer :
+
+    # Nearest palette color lookup, built once per palette and reused for all
+    # the data that is mapped to it. The index of the nearest palette color
+    # is stored in a table keyed by the packed (uint32) color, which grows as
+    # new colors are encountered, so that the brute-force distance search is
+    # done once per distinct color rather than once per pixel (and once per
+    # call). Results are identical to the brute-force search
+
+    def __init__(self, palette, **kwargs) :
+        self.palette = np.asarray(palette, dtype=float)
+        self.keys = np.empty(0, dtype=np.uint32)
+        self.indices = np.empty(0, dtype=np.intp)
+        self.mapping_kwargs = kwargs
+
+    def brute_force(self, data) :
+        return nearest_centers(data, self.palette, **self.mapping_kwargs)[0]
+
+    def index(self, data) :
+        # Only uint8 RGBA colors can be packed, anything else is searched
+        if data.dtype != np.uint8 :
+            return self.brute_force(data)
+
+        keys, inverse = np.unique(pack_colors(data), return_inverse=True)
+        indices = np.empty(keys.shape[0], dtype=np.intp)
+        known = np.zeros(keys.shape[0], dtype=bool)
+        if self.keys.shape[0] > 0 :
+            pos = np.minimum(np.searchsorted(self.keys, keys), 
+                self.keys.shape[0]-1)
+            known = self.keys[pos] == keys
+            indices[known] = self.indices[pos[known]]
+
+        # Search the new colors and add them to the table
+        new = ~known
+        if np.any(new) :
+            indices[new] = self.brute_force(
+                unpack_colors(keys[new]).astype(float))
+            insert_at = np.searchsorted(self.keys, keys[new])
+            self.keys = np.insert(self.keys, insert_at, keys[new])
+            self.indices = np.insert(self.indices, insert_at, indices[new])
+
+        return indices[inverse.reshape(-1)]
+
+#-----------------------------------------------------------------------------#
+
 class ImageProcessor :
 
-    def __init__(self, input_canvas, output_canvas) :
+    def __init__(self, input_canvas=None, output_canvas=None) :
         # Input, output canvases need to be objects that are or inherit from
-        # tkinter canvases
+        # tkinter canvases. They are optional, so that the processor can also
+        # run headless (see the process_image function), in which case the
+        # input image is passed via the image kwarg and the output is kept in
+        # self.output_image
         self.input_canvas = input_canvas
         self.output_canvas = output_canvas
         self.max_pixels = 128*128
@@ -176,48 +874,73 @@ class ImageProcessor :
 
         self.proc_mode_sv = None
         self.comp_mode_sv = None
+        self.proc_mode = self.default_proc_mode_name
+        self.comp_mode = self.default_comp_mode_name
 
+        self.output_image = None
         self.output_is_GBC_compatible = False
-        self.GBC_palette_map = None
+
+        # Indexed representation of the output, i.e. the (n_palettes, 
+        # palette_size, 4) palettes, the (tiles_y, tiles_x) palette index of
+        # each tile (a single (1, 1) entry in Default processor mode) and the
+        # (height, width) color index of each pixel in the palette of its tile
+        self.palettes = None
+        self.palette_map = None
+        self.index_map = None
+        self.palette_indexers = {}
+        self.mapping_kwargs = {}
+        self.default_tile_scoring = "avgnorm"
+        self.timings = {}
+        self.iters_saved = None
         self.tile_size = None
         self.asm_source = None
+        self.rom = None
+
+        # GBC encoded output (see create_asm), i.e. the (n_tiles, 16) 2bpp
+        # tile data, the (18, 20) tile map and attribute map, and the 
+        # (n_palettes, palette_size, 2) RGB555 palettes
+        self.tile_data = None
+        self.tile_map = None
+        self.attr_map = None
+        self.palette_data = None
     
     def best_palette_avg_norm(self, data, palettes) :
-        if palettes.shape[0] > 1 :
-            palettes_reshaped = palettes.reshape(
-                palettes.shape[0]*palettes.shape[1], palettes.shape[2])
-            palettes_sum_norm = np.zeros(palettes.shape[0])
-            for i, palette_color in enumerate(palettes_reshaped) :
-                palettes_sum_norm[int(np.floor(i/palettes.shape[1]))] += \
-                    np.sum(np.linalg.norm(data-palette_color, axis=1), axis=0)
-            return palettes[np.argmin(palettes_sum_norm)]
-        return palettes[0]
-
-    def best_palette_min_norm(data, palettes) :
-        if palettes.shape[0] > 1 :
-            palettes_reshaped = palettes.reshape(
-                palettes.shape[0]*palettes.shape[1], palettes.shape[2])
-            palettes_sum_norm = np.ones(palettes.shape[0])*1e12
-            for i, palette_color in enumerate(palettes_reshaped) :
-                I = int(np.floor(i/palettes.shape[1]))
-                palettes_sum_norm[I] = min(np.sum(np.linalg.norm(
-                    data-palette_color, axis=1), axis=0), palettes_sum_norm[I])
-            return palettes[np.argmin(palettes_sum_norm)]
-        return palettes[0]
+        return palettes[self.best_palette_index_avg_norm(data, palettes)]
+
+    def best_palette_index_avg_norm(self, data, palettes) :
+        return int(self.best_palettes_indices(data.reshape(1, 1, -1, 
+            data.shape[-1]), palettes, "avgnorm")[0,0])
+
+    def best_palette_min_norm(self, data, palettes) :
+        return palettes[int(self.best_palettes_indices(data.reshape(1, 1, -1,
+            data.shape[-1]), palettes, "minnorm")[0,0])]
+
+    def best_palettes_indices(self, tiles, palettes, scoring="avgnorm") :
+        # Score a whole (tiles_y, tiles_x, t_y, t_x, channels) array of tiles
+        # against all palettes with the scoring strategy (see tile_scorings),
+        # and return the (tiles_y, tiles_x) array (see palette_map_dtype) of
+        # the indices of the best (lowest scoring) palettes. The time spent 
+        # is recorded in self.timings under the name of the strategy (none if
+        # there is a single palette, there is nothing to score then)
+        tiles = tiles.reshape(tiles.shape[0], tiles.shape[1], -1, 
+            tiles.shape[-1])
+        if palettes.shape[0] == 1 :
+            self.timings.setdefault(scoring, 0.0)
+            return np.zeros(tiles.shape[:2], dtype=palette_map_dtype(palettes))
+        start_time = time.perf_counter()
+        scores = score_tiles(tiles.reshape(-1, tiles.shape[2], 
+            tiles.shape[3]), palettes, tile_scorings[scoring], 
+            **self.mapping_kwargs)
+        indices = np.argmin(scores, axis=1).astype(palette_map_dtype(
+            palettes)).reshape(tiles.shape[:2])
+        self.timings[scoring] = self.timings.get(scoring, 0.0)+\
+            time.perf_counter()-start_time
+        return indices
 
     def convert_color_bits(self, array, rgb_bits, unique=False) :
-        if rgb_bits == [16, 16, 16] :
-            return array
-        bit_scale = np.array([
-            float((2**(rgb_bits[0])-1))/255.0, 
-            float((2**(rgb_bits[1])-1))/255.0, 
-            float((2**(rgb_bits[2])-1))/255.0,
-            1.0])
-        if unique :
-            return np.unique(np.rint(np.divide(np.rint(np.multiply(
-                array, bit_scale)), bit_scale)), axis=0)
-        return np.rint(np.divide(np.rint(np.multiply(
-                array, bit_scale)), bit_scale))
+        if unique and list(rgb_bits) != [16, 16, 16] :
+            return np.unique(quantize_colors(array, rgb_bits), axis=0)
+        return quantize_colors(array, rgb_bits)
 
     def crop(self, im, target_aspect_ratio) :
         width, height = im.size
@@ -238,15 +961,32 @@ class ImageProcessor :
         # Returns a 1-D array of size data.shape[0] wherein each element 
         # consists of the index of the corresponding palette color that best
         # approximates the corresponding element in data
-        dists = np.sum(np.square(data[:,None,:]-palette[None,:,:]), 
-            axis=2)
-        ''' This commented bit is the slower version of the part above
-        dists = np.zeros((data.shape[0], 0))
-        for i, palette_color in enumerate(palette) :
-            d = np.linalg.norm((palette_color-data), axis=1)
-            dists = np.insert(dists, i, d, axis=1)
-        '''
-        return np.argmin(dists, axis=1)
+        return self.get_palette_indexer(palette).index(data)
+
+    def get_palette_indexer(self, palette) :
+        # One PaletteIndexer per distinct palette, reused across calls (e.g.
+        # for all the tiles that use the same palette)
+        key = (palette.shape, palette.tobytes())
+        if key not in self.palette_indexers :
+            self.palette_indexers[key] = PaletteIndexer(palette, 
+                **self.mapping_kwargs)
+        return self.palette_indexers[key]
+
+    def get_input_image(self, **kwargs) :
+        # The input image is either passed explicitly via the image kwarg 
+        # (as a PIL image or as an array) or read from the input canvas. In 
+        # both cases a RGBA copy is returned
+        image = kwargs.get("image", None)
+        if image is None :
+            image = self.input_canvas.image_no_zoom_PIL_RGB
+        if isinstance(image, np.ndarray) :
+            image = Image.fromarray(image)
+        return image.convert("RGBA")
+
+    def set_output_image(self, output_image) :
+        self.output_image = output_image
+        if self.output_canvas is not None :
+            self.output_canvas.set_zoom_draw_image(output_image)
 
     def replace_from_palette(self, data, palette) :
         palette_index_map = self.data_to_palette_index_map(data, palette)
@@ -268,50 +1008,78 @@ class ImageProcessor :
         # Get or default
         max_pixels = kwargs.get("maxpixels", self.max_pixels)
 
+        # If quantizeinput is True, the k-means runs on the colors snapped to
+        # the rgb_bits grid, so that its cost is bounded by the size of that
+        # grid rather than by the number of pixels, and all the output pixels
+        # can be clustered
+        quantize_input = kwargs.get("quantizeinput", False)
+        if quantize_input :
+            max_pixels = max(max_pixels, out_x*out_y)
+
+        # If coarsetofine is True, the k-means runs on all the output pixels
+        # too, but most of its iterations run on subsamples of them (see 
+        # coarse_to_fine_kmeans)
+        coarse_to_fine = kwargs.get("coarsetofine", False)
+        if coarse_to_fine :
+            max_pixels = max(max_pixels, out_x*out_y)
+
         # Load image as copy and resize to operate the k-means on at most
         # self.max_pixels pixels (because it's time consuming), shape them into
         # a 1D array and operate k-means on them to find clusters of size 
         # n_colors
-        kmeans_image = self.input_canvas.image_no_zoom_PIL_RGB.copy()
+        input_image = self.get_input_image(**kwargs)
+        kmeans_image = input_image.copy()
         n_pixels = out_x*out_y
         scale = np.sqrt(max_pixels/n_pixels)
         kmeans_image = self.crop(kmeans_image, aspect_ratio)
-        kmeans_image = kmeans_image.resize((int(out_x*min(scale, 1.0)), 
-            int(out_y*min(1.0, scale))), resample=Image.NEAREST)
+        # With sampling "coreset" or "stratified", the k-means runs instead 
+        # on a weighted sample of max_pixels colors drawn from the histogram
+        # of the whole (cropped) input image, see sample_colors
+        sampling = kwargs.get("sampling", "nearest")
+        if sampling == "nearest" :
+            kmeans_image = kmeans_image.resize((int(out_x*min(scale, 1.0)), 
+                int(out_y*min(1.0, scale))), resample=Image.NEAREST)
         data = np.array(kmeans_image)
-        data = data.reshape(data.shape[0]*data.shape[1], data.shape[2])
-        k_means = KMeans(data=data, k=palette_size, fidelity=fidelity, 
-            printinfo=False)
+        k_means = kmeans_region(data, (0, data.shape[0], 0, data.shape[1]),
+            sampling=sampling, samplesize=max_pixels, 
+            coarsetofine=coarse_to_fine, 
+            coarsepixels=kwargs.get("coarsepixels", 64*64), k=palette_size,
+            fidelity=fidelity, quantizer=kwargs.get("quantizer", "kmeans"),
+            refineiters=kwargs.get("refineiters", 3),
+            init=kwargs.get("kmeansinit", "kmeans++"), 
+            engine=kwargs.get("kmeansengine", "lloyd"),
+            batchsize=kwargs.get("batchsize", 1024),
+            seed=kwargs.get("seed", None), rgbbits=rgb_bits, 
+            quantize=quantize_input, snapmeans=kwargs.get("snapmeans", False),
+            reportsavings=kwargs.get("reportsavings", False), 
+            printinfo=False, **self.mapping_kwargs)
 
         # Prepare output image (cropping and such)
-        output_image = self.input_canvas.image_no_zoom_PIL_RGB.copy()
-        output_image = self.crop(output_image, aspect_ratio)
+        output_image = self.crop(input_image, aspect_ratio)
         output_image = output_image.resize((out_x, out_y))
 
         # Convert color palette into 8 bit
+        self.record_iters_saved([getattr(k_means, "iters_saved", None)])
         k_means.means = self.convert_color_bits(k_means.means, 
             rgb_bits)
 
-        # Replace colors in output with colors in palette
+        # A single palette is used for the whole image, so the index map is
+        # just the index of the palette color that replaces each output pixel
+        self.palettes = np.array([k_means.means])
+        self.palette_map = np.zeros((1, 1), dtype=np.uint8)
         data = np.array(output_image)
-        orig_shape = data.shape
-        data = data.reshape(data.shape[0]*data.shape[1], data.shape[2])
-        self.replace_from_palette(data, k_means.means)
-        data = data.reshape(orig_shape)
+        self.index_map = self.data_to_palette_index_map(data.reshape(
+            data.shape[0]*data.shape[1], data.shape[2]), 
+            k_means.means).astype(index_dtype(self.palettes)).reshape(
+            data.shape[:2])
         
         # Convert back to image and draw to canvas
-        output_image = Image.fromarray(data)
-        self.output_canvas.set_zoom_draw_image(output_image)
+        output_image = Image.fromarray(self.render_output())
+        self.set_output_image(output_image)
 
-        # Set self.GBC_palette_map if in GBC_comp_mode
         if self.comp_mode == self.GBC_comp_mode_name :
-            self.GBC_palette_map = [
-                [k_means.means for i in range(20)] for i in range(18)]
-            self.palettes = np.array([k_means.means])
             self.tile_size = (8, 8) # Useless, I keep it for consistency
         else :
-            self.GBC_palette_map = None
-            self.palettes = None
             self.tile_size = None
 
     def process_tiled(self, **kwargs) :
@@ -332,19 +1100,33 @@ class ImageProcessor :
         # Get or default
         max_pixels = kwargs.get("maxpixels", self.max_pixels)
 
-        input_image = self.input_canvas.image_no_zoom_PIL_RGB.copy()
+        # See process_default
+        quantize_input = kwargs.get("quantizeinput", False)
+        coarse_to_fine = kwargs.get("coarsetofine", False)
+        if quantize_input or coarse_to_fine :
+            max_pixels = max(max_pixels, int(out_x*out_y/n_palettes)+1)
+
+        input_image = self.get_input_image(**kwargs)
         input_image = self.crop(input_image, aspect_ratio)
         output_image = input_image.copy()
         output_image = output_image.resize((out_x, out_y))
         output_data = np.array(output_image)
         n_pixels = out_x*out_y
         scale = np.sqrt(max_pixels*n_palettes/n_pixels)
-        input_image = input_image.resize((int(out_x*min(scale, 1.0)), 
-            int(out_y*min(1.0, scale))), resample=Image.LANCZOS)
+        # With sampling "coreset" or "stratified", each region is sampled
+        # from the whole (cropped) input image instead, see process_default
+        sampling = kwargs.get("sampling", "nearest")
+        if sampling == "nearest" :
+            input_image = input_image.resize((int(out_x*min(scale, 1.0)), 
+                int(out_y*min(1.0, scale))), resample=Image.LANCZOS)
         data = np.array(input_image)
 
-        # Determine palettes
-        palettes = []
+        # Determine palettes, one per region of the palettes grid (listed in
+        # grid order). Each region gets its own independent seed, spawned 
+        # from the (optional) seed kwarg
+        seeds = np.random.SeedSequence(kwargs.get("seed", None)).spawn(
+            n_palettes)
+        regions = []
         dy = np.floor(data.shape[0]/palettes_grid_y)
         dx = np.floor(data.shape[1]/palettes_grid_x)
         #start_time = time.perf_counter()
@@ -353,81 +1135,181 @@ class ImageProcessor :
             end_y = int(dy*(i+1))
             if i == palettes_grid_y-1 :
                 end_y = data.shape[0]
-            data_cut_y = np.split(data, [start_y, end_y], axis=0)[1]
             for j in range(palettes_grid_x) :
                 start_x = int(dx*j)
                 end_x = int(dx*(j+1))
                 if j == palettes_grid_x-1 :
                     end_x = data.shape[1]
-                data_cut_xy = np.split(data_cut_y, [start_x, end_x], axis=1)[1]
-                data_cut_xy = data_cut_xy.reshape(
-                    data_cut_xy.shape[0]*data_cut_xy.shape[1], 
-                    data_cut_xy.shape[2])
-                k_means = KMeans(data=data_cut_xy, k=palette_size, 
-                    fidelity=fidelity)
-                k_means.means = self.convert_color_bits(k_means.means,
-                    rgb_bits)
-                palettes.append(k_means.means)
-        palettes = np.asarray(palettes)
+                regions.append((start_y, end_y, start_x, end_x))
+        palettes = self.kmeans_regions(data, regions, seeds, 
+            processes=kwargs.get("processes", 1), 
+            batched=kwargs.get("batchedkmeans", False), k=palette_size, 
+            quantizer=kwargs.get("quantizer", "kmeans"),
+            refineiters=kwargs.get("refineiters", 3),
+            sampling=sampling, samplesize=max_pixels,
+            coarsetofine=coarse_to_fine, 
+            coarsepixels=kwargs.get("coarsepixels", 64*64),
+            fidelity=fidelity, init=kwargs.get("kmeansinit", "kmeans++"),
+            engine=kwargs.get("kmeansengine", "lloyd"), 
+            batchsize=kwargs.get("batchsize", 1024), rgbbits=rgb_bits,
+            quantize=quantize_input, snapmeans=kwargs.get("snapmeans", False),
+            reportsavings=kwargs.get("reportsavings", False), 
+            **self.mapping_kwargs)
+        palettes = np.asarray([self.convert_color_bits(means, rgb_bits) 
+            for means in palettes])
         #print("Dt k-means =", (time.perf_counter()-start_time))
 
+        # Determine best palette for each tile. This is done on downsampled
+        # tiles of at most 16x16 pixels, obtained by resizing the whole output
+        # image at once (so that tile edges are filtered across neighbouring
+        # tiles as well). All tiles are scored against all palettes together
+        max_tile_pixels = 16*16
+        #start_time = time.perf_counter()
+        score_data = output_data
+        if (t_x*t_y > max_tile_pixels) :
+            scale = np.sqrt(max_tile_pixels/(t_x*t_y))
+            score_t_x = max(1, int(t_x*scale))
+            score_t_y = max(1, int(t_y*scale))
+            score_data = np.array(output_image.resize((out_t_x*score_t_x, 
+                out_t_y*score_t_y), resample=Image.LANCZOS))
+        tile_scoring = kwargs.get("tilescoring", self.default_tile_scoring)
+        self.palette_map = self.best_palettes_indices(
+            tiles_view(score_data, out_t_x, out_t_y), palettes, tile_scoring)
+        if kwargs.get("printtimings", False) :
+            print("Tile scoring ("+tile_scoring+"):", 
+                self.timings[tile_scoring], "s")
+
+        self.palettes = palettes.copy()
         if self.comp_mode == self.GBC_comp_mode_name :
-            self.GBC_palette_map = [
-                [None for i in range(out_t_x)] for i in range(out_t_y)]
-            self.palettes = palettes.copy()
             self.tile_size = (t_x, t_y)
         else :
-            self.GBC_palette_map = None
-            self.palettes = None
             self.tile_size = None
 
-        # Determine best palette for each tile. This is done or downsampled
-        # tiles of 16x16. Then, perform the color quantization and assemble
-        # the output image from the processed tiles
-        max_tile_pixels = 16*16
-        #start_time = time.perf_counter()
-        out = np.empty((0, out_x, 4))
-        for j in range(out_t_y) :
-            hout = np.empty((t_y, 0, 4))
-            for i in range(out_t_x) :
-                box = (i*t_x, j*t_y, (i+1)*t_x, (j+1)*t_y)
-                tile = output_image.crop(box)
-                proc_tile = tile.copy()
-                n_pixels = tile.width*tile.height
-                if (n_pixels > max_tile_pixels) :
-                    scale = np.sqrt(max_tile_pixels/n_pixels)
-                    proc_tile = proc_tile.resize((int(tile.width*scale), 
-                        int(tile.height*scale)), resample=Image.LANCZOS)
-                data = np.array(proc_tile)
-                best_palette = self.best_palette_avg_norm(
-                    data.reshape(data.shape[0]*data.shape[1], data.shape[2]),
-                    palettes)
-                if self.comp_mode == self.GBC_comp_mode_name :
-                    self.GBC_palette_map[j][i] = best_palette
-                data = np.array(tile)
-                orig_shape = data.shape
-                self.replace_from_palette(
-                    data.reshape(data.shape[0]*data.shape[1], data.shape[2]),
-                    best_palette)
-                data = data.reshape(orig_shape)
-                hout = np.hstack((hout, data))
-            out = np.vstack((out, hout))
+        # Map the pixels of all the tiles that use the same palette to their
+        # palette color indices at once, writing straight into the 
+        # preallocated index map
+        self.index_map = np.empty(output_data.shape[:2], 
+            dtype=index_dtype(palettes))
+        output_tiles = tiles_view(output_data, out_t_x, out_t_y)
+        index_tiles = tiles_view(self.index_map[:,:,None], out_t_x, out_t_y)
+        for i, palette in enumerate(palettes) :
+            mask = self.palette_map == i
+            if not np.any(mask) :
+                continue
+            tiles = output_tiles[mask]
+            index_tiles[mask] = self.data_to_palette_index_map(tiles.reshape(
+                -1, tiles.shape[-1]), palette).reshape(tiles.shape[:-1]+(1,))
         #print("Dt substitution =", (time.perf_counter()-start_time))
 
         # Convert back to image and draw to canvas
-        output_image = Image.fromarray(out.astype(np.uint8))
-        self.output_canvas.set_zoom_draw_image(output_image)
+        output_image = Image.fromarray(self.render_output())
+        self.set_output_image(output_image)
+
+    def render_output(self) :
+        # Output (height, width, 4) RGBA data built from the indexed
+        # representation, i.e. from the palette of each pixel's tile (see
+        # self.palette_map) and the pixel's color index in that palette (see
+        # self.index_map)
+        height, width = self.index_map.shape
+        pixels_palettes = np.repeat(np.repeat(self.palette_map, 
+            int(height/self.palette_map.shape[0]), axis=0), 
+            int(width/self.palette_map.shape[1]), axis=1)
+        return self.palettes[pixels_palettes, self.index_map].astype(np.uint8)
+
+    def kmeans_regions(self, data, regions, seeds, **kwargs) :
+        # Run an independent quantizer (see run_quantizer) on each (start_y,
+        # end_y, start_x, end_x) region of data, and return the means in the
+        # same order as regions. If processes > 1, the regions are dispatched
+        # to a pool of processes that read data from shared memory (so it is
+        # never pickled), each with its share of threads and memorybudget. If
+        # batched is True and the quantizer is a (Lloyd or Hamerly) KMeans, 
+        # not run coarse-to-fine nor on a sample, all regions are instead 
+        # solved together in this process by a BatchedKMeans
+        processes = min(kwargs.pop("processes", 1), len(regions))
+        batched = kwargs.pop("batched", False)
+        quantizer, batched_kwargs = quantizer_kwargs(**kwargs)
+        if (batched and quantizer is KMeans and 
+            not kwargs.get("coarsetofine", False) and 
+            kwargs.get("sampling", "nearest") == "nearest" and 
+            kwargs.get("engine", "lloyd") != "minibatch") :
+            datasets = []
+            for start_y, end_y, start_x, end_x in regions :
+                region_data = data[start_y:end_y, start_x:end_x]
+                datasets.append(region_data.reshape(
+                    region_data.shape[0]*region_data.shape[1], 
+                    region_data.shape[2]))
+            batched_k_means = BatchedKMeans(datasets=datasets, seeds=seeds, 
+                **batched_kwargs)
+            self.record_iters_saved([problem.iters_saved 
+                for problem in batched_k_means.problems])
+            return batched_k_means.means
+        if processes <= 1 :
+            quantizers = [kmeans_region(data, region, seed=seed, **kwargs) 
+                for region, seed in zip(regions, seeds)]
+            self.record_iters_saved([getattr(quantizer, "iters_saved", None)
+                for quantizer in quantizers])
+            return [quantizer.means for quantizer in quantizers]
+
+        # The threads and memory budget are shared among the workers, so that
+        # the pool as a whole stays within them
+        worker_kwargs = dict(kwargs, 
+            threads=max(1, kwargs.get("threads", n_threads)//processes),
+            memorybudget=max(1, kwargs.get("memorybudget", 
+                memory_budget)//processes))
+        shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+        try :
+            np.ndarray(data.shape, dtype=data.dtype, buffer=shm.buf)[:] = data
+            with ProcessPoolExecutor(max_workers=processes) as executor :
+                futures = [executor.submit(kmeans_shared_region, shm.name, 
+                    data.shape, data.dtype, region, seed=seed, 
+                    **worker_kwargs) 
+                    for region, seed in zip(regions, seeds)]
+                results = [future.result() for future in futures]
+        finally :
+            shm.close()
+            shm.unlink()
+        self.record_iters_saved([result[1] for result in results])
+        return [result[0] for result in results]
+
+    # Set self.iters_saved to the total number of k-means iterations saved by
+    # snapping the means (see KMeans.report_savings), given the iters_saved
+    # of each quantizer (None if not reported, e.g. for non k-means ones)
+    def record_iters_saved(self, iters_saved) :
+        iters_saved = [n for n in iters_saved if n is not None]
+        self.iters_saved = int(sum(iters_saved)) if iters_saved else None
 
     def process(self, **kwargs) :
-        self.proc_mode = self.proc_mode_sv.get()
-        self.comp_mode = self.comp_mode_sv.get()
+        # Palettes (and timings) are re-computed at every run
+        self.palette_indexers = {}
+        self.timings = {}
+        self.iters_saved = None
+
+        # Memory budget (in bytes) and number of threads used when mapping
+        # pixels to palettes, see nearest_centers
+        self.mapping_kwargs = {
+            "memorybudget" : kwargs.get("memorybudget", memory_budget),
+            "threads" : kwargs.get("threads", n_threads)}
+
+        # The processor and compatibility modes are either passed explicitly
+        # via the procmode, compmode kwargs or read from the tkinter StringVars
+        # linked to the GUI
+        self.proc_mode = kwargs.get("procmode", None)
+        if self.proc_mode is None and self.proc_mode_sv is not None :
+            self.proc_mode = self.proc_mode_sv.get()
+        elif self.proc_mode is None :
+            self.proc_mode = self.default_proc_mode_name
+        self.comp_mode = kwargs.get("compmode", None)
+        if self.comp_mode is None and self.comp_mode_sv is not None :
+            self.comp_mode = self.comp_mode_sv.get()
+        elif self.comp_mode is None :
+            self.comp_mode = self.default_comp_mode_name
 
         if (self.comp_mode == self.GBC_comp_mode_name and 
             self.proc_mode == self.tiled_proc_mode_name) :
             if kwargs["palettesgridsize"][0]*kwargs["palettesgridsize"][1] > 8:
                 print("Cannot run processor in Game Boy Color compatibility \
                         mode if the total palettes grid size (x*y) exceeds 8")
-                return
+                return False
 
         if self.proc_mode == self.default_proc_mode_name :
             self.process_default(**kwargs)
@@ -443,8 +1325,11 @@ class ImageProcessor :
 
         # Copy filename and path from input canvas to enable saving the image
         # from the output canvas
-        self.output_canvas.filename = self.input_canvas.filename
-        self.output_canvas.filepath = self.input_canvas.filepath
+        if self.input_canvas is not None and self.output_canvas is not None :
+            self.output_canvas.filename = self.input_canvas.filename
+            self.output_canvas.filepath = self.input_canvas.filepath
+
+        return True
 
     '''
     This function converts the output_image and converts it to a Game Boy 
@@ -458,354 +1343,829 @@ class ImageProcessor :
         rgbfix -C -v -p 0 main.gb <= the C option denots a GBC ROM instead of a
                                      GB ROM, it will not compile properly 
                                      without it!
-    To skip the manual compilation step, if you are on a 64-bit Windows system,
-    you can use the 'Compile .gb file button'
+    To skip the manual compilation step, you can use the 'Compile .gb file 
+    button', which builds the very same ROM directly (see create_rom)
     '''
-    def create_asm(self) :
+    def create_asm(self, **kwargs) :
         if not(self.output_is_GBC_compatible) :
             return
+        self.encode_gbc(**kwargs)
+        self.asm_source = self.format_asm()
 
-        t_x = self.tile_size[0]
-        t_y = self.tile_size[1]
+    # Build the .gb ROM image of the output into self.rom, without assembling
+    # the asm source
+    def create_rom(self, **kwargs) :
+        if not(self.output_is_GBC_compatible) :
+            return
+        self.encode_gbc(**kwargs)
+        self.rom = self.format_rom()
+
+    # Encode the output into the GBC tile data, tile map, attribute map and
+    # palettes both the asm source and the ROM are made of
+    def encode_gbc(self, **kwargs) :
+        # Palette index of each of the 20x18 8x8 tiles, i.e. the palettes map
+        # "stretched" from the (possibly larger) tiles of the processor
+        tiles_palettes = np.repeat(np.repeat(self.palette_map, 
+            int(18/self.palette_map.shape[0]), axis=0), 
+            int(20/self.palette_map.shape[1]), axis=1)
 
-        def GBC_hex_format(h) :
-            if len(h) == 1 :
-                return "$0"+h
-            else :
-                return "$"+h
-
-        # Check palettes map dimensions, and if not equal to adequate GBC ones,
-        # "stretch" it
-        self.GBC_palette_map = np.array(self.GBC_palette_map)
-        x_shape = self.GBC_palette_map.shape[1]
-        y_shape = self.GBC_palette_map.shape[0]
-        if x_shape != 20 : 
-            hout = np.empty((y_shape, 0, 4, 4))
-            n = int(t_x/8)
-            for col in range(x_shape) :
-                for i in range(n) :
-                    hout = np.hstack((hout, 
-                        self.GBC_palette_map[:,col].reshape(y_shape, 1, 4, 4)))
-            self.GBC_palette_map = hout.copy()
-            x_shape = self.GBC_palette_map.shape[1]
-        if y_shape != 18 : 
-            vout = np.empty((0, x_shape, 4, 4))
-            n = int(t_y/8)
-            for row in range(y_shape) :
-                for i in range(n) :
-                    vout = np.vstack((vout, 
-                        self.GBC_palette_map[row,:].reshape(1, x_shape, 4, 4)))
-            self.GBC_palette_map = vout.copy()
-            y_shape = self.GBC_palette_map.shape[0]
-
-        output_image = self.output_canvas.image_no_zoom_PIL_RGB.copy()
-
-        class GBTile :
-            def __init__(self, bits) :
-                self.bits = bits.copy()
-                self.id = ""
-                for b in reversed(self.bits) :
-                    self.id+=str(format(int(b, 2), "x"))
-                for i in range(len(self.bits)) :
-                    self.bits[i] = GBC_hex_format(
-                        format(int(self.bits[i], 2), "x").upper())
-            def __eq__(self, rhs) :
-                return self.id == rhs.id
-            def __ne__(self, rhs) :
-                return not (self==rhs)
-
-        palettes_indices = []
-        tiles_indices = []
-        tiles = []
-        for j in range(18) :
-            for i in range(20) :
-                palette = self.GBC_palette_map[j][i]
-                lpalette = palette.tolist()
-                palette_index = self.palettes.tolist().index(palette.tolist())
-                palettes_indices.append(palette_index)
-
-                box = (i*8, j*8, (i+1)*8, (j+1)*8)
-                tile = output_image.crop(box)
-                tile = np.array(tile)
-                # tile_palette_index is an 8x8 array just like tile. The tile
-                # array is such that each [j,i] element contains an rgb color.
-                # tile_palette_index instead is such that each [j,i] element
-                # is an integer between 0 and 3 that represents one of the four
-                # colors in palette. In particular, that number is the index
-                # of the color in the palette list that corresponds to the 
-                # color in position [j,i] of tile.
-                tile_palette_index = self.data_to_palette_index_map(
-                    tile.reshape(tile.shape[0]*tile.shape[1], tile.shape[2]), 
-                    palette).reshape(tile.shape[0], tile.shape[1])
-
-                '''
-                Quick reminder on how Game Boy (Color or not) tiles work.
-                All of the graphics is based on 8x8 pixel tiles. Each tile is a
-                collection of numbers ranging from 0 to 3, representing one of
-                the four possible colors a pixel can assume. The actual color
-                value (in hex RGB 555 format) is stored elsewhere, in a map
-                that indicats which tile uses which palette (i.e. which set of 
-                four colors). The big difference between the Game Boy and the 
-                Game Boy Color is that the former supports only one palette for
-                all tiles (and you cannot really change it, it is white, black,
-                and two shades of gray), while the latter supports a maximum of
-                8 different color palettes. Regardless, the fundamental 
-                representation is the same. Take the following tile:
-
-                0 1 2 2 1 1 3 0
-                0 2 2 2 2 3 3 1
-                1 0 0 0 2 0 0 2
-                2 1 1 1 3 3 3 2
-                0 2 1 3 0 2 1 3
-                0 0 0 1 1 0 0 0
-                2 2 3 3 1 3 0 0
-                3 2 1 0 3 2 1 0
-                
-                The way this is stored is the following. For each line,
-                convert each number into a binary format and store the low and
-                the high bits for each number (there is only 2 bits as the 
-                numbers are in the 0-3 range) in separate arrays. Then convert
-                each array into hex numbers and store them in a little endian
-                way (the row of the low bits first, the row of the high bits
-                second). If this sounds confusing, let us make an example, let
-                us consider the first row:
-
-                0 1 2 2 1 1 3 0
-
-                After binary conversion, we have:
-
-                00 01 10 10 01 01 11 00
-
-                For each number, the first digit is the high bit, and the 
-                second digit is the low bit (). Now, store the low bits and 
-                high bits separately, so that:
-
-                low_bits =  [0 1 0 0 1 1 1 0]
-                high_bits = [0 0 1 1 0 0 1 0]
-
-                the low and high bits are then both translated into hex numbers
-                (the leading 0s are inconsequential but have been bracketed for
-                clarity) :
-
-                low_bits =  [0 1 0 0 1 1 1 0] = (0)1001110 = 0x4E
-                high_bits = [0 0 1 1 0 0 1 0] = (00)110010 = 0x32
-
-                Thus, the first row is converted into two hex numbers in the 
-                0-255 range. These two numbers are stored in memory in a little
-                endian way, so that the final representation of the first row
-                in memory is 0x4E 0x32 in two adjecent memory locations wherein
-                the address of the second is the adderss of the first + 1.
-                This is repeated for all 8 rows, so that each tile is 
-                represented as 16 numbers in hex format in the 0-255 range 
-                stored in 16 adjacent memory addresses in a little endian 
-                format.
-                '''
-                tile_bits = []
-                for row in tile_palette_index :
-                    # Get low and high bits in string binary format, then 
-                    # convert to hex, and pad with leading 0s if necessary
-                    low_bits = np.array2string(
-                        np.remainder(row, 2).astype(int), 
-                        separator="").lstrip("[").rstrip("]")
-                    high_bits = np.array2string(
-                        np.remainder(np.floor(row/2), 2).astype(int), 
-                        separator="").lstrip("[").rstrip("]")
-                    tile_bits.append(low_bits)
-                    tile_bits.append(high_bits)
+        '''
+        Quick reminder on how Game Boy (Color or not) tiles work.
+        All of the graphics is based on 8x8 pixel tiles. Each tile is a
+        collection of numbers ranging from 0 to 3, representing one of
+        the four possible colors a pixel can assume. The actual color
+        value (in hex RGB 555 format) is stored elsewhere, in a map
+        that indicats which tile uses which palette (i.e. which set of 
+        four colors). The big difference between the Game Boy and the 
+        Game Boy Color is that the former supports only one palette for
+        all tiles (and you cannot really change it, it is white, black,
+        and two shades of gray), while the latter supports a maximum of
+        8 different color palettes. Regardless, the fundamental 
+        representation is the same. Take the following tile:
+
+        0 1 2 2 1 1 3 0
+        0 2 2 2 2 3 3 1
+        1 0 0 0 2 0 0 2
+        2 1 1 1 3 3 3 2
+        0 2 1 3 0 2 1 3
+        0 0 0 1 1 0 0 0
+        2 2 3 3 1 3 0 0
+        3 2 1 0 3 2 1 0
                 
-                # Add tile to tiles (i.e. pattern table) only if id did not
-                # already appear, and set the correct tile_index for this tile
-                # accordingly
-                tile = GBTile(tile_bits)
-                tile_index = None
-                for k, tilek in enumerate(tiles) :
-                    if tilek == tile :
-                        tile_index = k
-                        break
-                if tile_index == None :
-                    tiles.append(tile)
-                    tile_index = len(tiles)-1
-                tiles_indices.append(tile_index)
+        The way this is stored is the following. For each line,
+        convert each number into a binary format and store the low and
+        the high bits for each number (there is only 2 bits as the 
+        numbers are in the 0-3 range) in separate arrays. Then convert
+        each array into hex numbers and store them in a little endian
+        way (the row of the low bits first, the row of the high bits
+        second). If this sounds confusing, let us make an example, let
+        us consider the first row:
+
+        0 1 2 2 1 1 3 0
+
+        After binary conversion, we have:
+
+        00 01 10 10 01 01 11 00
+
+        For each number, the first digit is the high bit, and the 
+        second digit is the low bit (). Now, store the low bits and 
+        high bits separately, so that:
+
+        low_bits =  [0 1 0 0 1 1 1 0]
+        high_bits = [0 0 1 1 0 0 1 0]
+
+        the low and high bits are then both translated into hex numbers
+        (the leading 0s are inconsequential but have been bracketed for
+        clarity) :
+
+        low_bits =  [0 1 0 0 1 1 1 0] = (0)1001110 = 0x4E
+        high_bits = [0 0 1 1 0 0 1 0] = (00)110010 = 0x32
+
+        Thus, the first row is converted into two hex numbers in the 
+        0-255 range. These two numbers are stored in memory in a little
+        endian way, so that the final representation of the first row
+        in memory is 0x4E 0x32 in two adjecent memory locations wherein
+        the address of the second is the adderss of the first + 1.
+        This is repeated for all 8 rows, so that each tile is 
+        represented as 16 numbers in hex format in the 0-255 range 
+        stored in 16 adjacent memory addresses in a little endian 
+        format.
+        '''
+        # Encode the (18, 20, 8, 8) color indices of all the tiles at once,
+        # along with their horizontally, vertically and both ways flipped
+        # versions if flipped tiles are to be reused too
+        tiles_indices_maps = tiles_view(self.index_map[:,:,None], 20, 18)[
+            ...,0]
+        tiles = encode_2bpp(tiles_indices_maps).reshape(-1, 16)
+        flipped_tiles = []
+        if kwargs.get("tileflips", False) :
+            flipped_tiles = [(encode_2bpp(tiles_indices_maps[...,::-1,::-1]
+                ).reshape(-1, 16), tile_flip_attrs["xy"]), 
+                (encode_2bpp(tiles_indices_maps[...,::-1,:]).reshape(-1, 16),
+                tile_flip_attrs["y"]), (encode_2bpp(
+                tiles_indices_maps[...,::-1]).reshape(-1, 16), 
+                tile_flip_attrs["x"])]
+
+        # Add each tile to the pattern table only if neither it nor (if 
+        # enabled) one of its flipped versions already appeared, and set the 
+        # correct tile index and flip attributes for it accordingly. Each new
+        # tile also registers its flipped versions, so that a later tile equal
+        # to one of them is drawn by flipping it back
+        tiles_table = {}
+        tiles_indices = np.empty(len(tiles), dtype=np.intp)
+        flips = np.zeros(len(tiles), dtype=np.uint8)
+        first = []
+        for i, tile in enumerate(tiles) :
+            key = tile.tobytes()
+            if key not in tiles_table :
+                for flipped, attr in flipped_tiles :
+                    tiles_table[flipped[i].tobytes()] = (len(first), attr)
+                tiles_table[key] = (len(first), 0)
+                first.append(i)
+            tiles_indices[i], flips[i] = tiles_table[key]
+        tiles_indices = tiles_indices.reshape(18, 20)
+
+        # Encoded tile data, tile map and attribute map (bit 3 of each 
+        # attribute set to 1 tells to use bg characters in bank1, as the map 
+        # can only address 256 tiles per bank, bits 5 and 6 flip the tile 
+        # horizontally and vertically) and palettes
+        self.tile_data = tiles[first]
+        self.tile_map = (tiles_indices % 256).astype(np.uint8)
+        self.attr_map = (tiles_palettes+8*(tiles_indices >= 256)+
+            flips.reshape(18, 20)).astype(np.uint8)
+        self.palette_data = encode_rgb555(self.palettes)
+
+    # Format the asm source from the encoded palettes, tile data, tile map and
+    # attribute map (see create_asm)
+    def format_asm(self) :
+        return "".join(self.iter_asm())
+
+    # Write the asm source to the text file-like object file, section by 
+    # section, without ever holding all of it in memory
+    def write_asm(self, file) :
+        for chunk in self.iter_asm() :
+            file.write(chunk)
+
+    # Generate the chunks of text the asm source is made of, in order
+    def iter_asm(self) :
+        n_tiles = len(self.tile_data)
 
         # Write the source header, the only info it requires is the number of
         # palettes that are present and info on whether the second memory bank
         # for the tile table is necessary (only if I have more than 256 tiles)
-        self.asm_source = vd.fill_from_source_header_to_palettes_start(
-            len(self.palettes), len(tiles) > 256)
+        yield vd.fill_from_source_header_to_palettes_start(
+            len(self.palettes), n_tiles > 256)
 
         # Write palettes to source
-        for i, palette in enumerate(self.palettes) :
-            self.asm_source += ("               ; Palette "+str(i)+"\n")
-            for j, color in enumerate(palette) :
-                color_hex_rgb555 = format(
-                    np.floor(color[0]/8).astype(int)+
-                    np.floor(color[1]/8).astype(int)*32+
-                    np.floor(color[2]/8).astype(int)*1024, "x").upper()
-                while len(color_hex_rgb555) < 4 :
-                    color_hex_rgb555 = "0"+color_hex_rgb555
-                hi_nibble = color_hex_rgb555[0]+color_hex_rgb555[1]
-                lo_nibble = color_hex_rgb555[2]+color_hex_rgb555[3]
-                color_line = ("    DB $"+lo_nibble+",$"+hi_nibble)
-                color_line += (" ; $ 16-bit RGB = "+
+        for i, palette in enumerate(self.palette_data) :
+            yield "               ; Palette "+str(i)+"\n"
+            for word, color in zip(palette, self.palettes[i]) :
+                yield (asm_db(word)+" ; $ 16-bit RGB = "+
                     np.array2string(np.array(color).astype(int))+"\n")
-                self.asm_source += color_line
 
-        # 
-        self.asm_source += vd.fill_from_palettes_end_to_bank0_tile_start()
-
-        # Write tiles to bank0
-        for i, tile in enumerate(tiles) :
-            if i < 256 :
-                self.asm_source += ("    DB ")
-                for j, line in enumerate(tile.bits) :
-                    if j != 8 :
-                        self.asm_source += (line)
-                    else :
-                        lineNum = GBC_hex_format(format(i, "x").upper())
-                        self.asm_source += (" ; tile "+str(i)+" / "+
-                            lineNum+"\n"+"    DB "+line)
-                    if j < 15 and j != 7:
-                        self.asm_source += (",")
-                self.asm_source += ("\n")
-
-        #
-        self.asm_source += vd.fill_from_bank0_tile_end_to_bank1_tile_start()
-
-        # Write tiles that go to bank 1 of the tile map
-        for i, tile in enumerate(tiles) :
-            if i >= 256 :
-                self.asm_source += ("    DB ")
-                for j, line in enumerate(tile.bits) :
-                    if j != 8 :
-                        self.asm_source += (line)
-                    else :
-                        lineNum = GBC_hex_format(format(i, "x").upper())
-                        self.asm_source += (" ; tile "+str(i)+" / "+
-                            lineNum+"\n"+"    DB "+line)
-                    if j < 15 and j != 7:
-                        self.asm_source += (",")
-                self.asm_source += ("\n")
-
-        #
-        self.asm_source += vd.fill_from_bank1_tile_end_to_bank0_map_start()
-
-        # Write actual map
-        for i in range(18) :
-            self.asm_source += ("    DB ")
-            for j in range(20) :
-                I = tiles_indices[20*i+j]
-                if I >= 256 :
-                    I -= 256
-                n = GBC_hex_format(format(I, "x").upper())
-                if j != 10 :
-                    self.asm_source += (n)
-                else :
-                    self.asm_source += (" ; line "+str(i)+"\n"+"    DB "+n)
-                if j < 19 and j != 9 :
-                    self.asm_source += (",")
-            self.asm_source += ("\n")
-
-        #
-        self.asm_source += vd.fill_from_bank0_map_end_to_bank1_map_start()
-
-        # Write palette map
-        for i, palettes_index in enumerate(palettes_indices) :
-            if i%10 == 0 :
-                self.asm_source += ("    DB ")
-            # Bit 3 of pi set to 1 tells to use bg characters in bank1
-            # So, bin 00001000 == dec 8, and we need to add it to the palette 
-            # number
-            if tiles_indices[i] >= 256 :
-                pi = GBC_hex_format(format((palettes_index+8), "x").upper())
+        # Write tiles to bank0, then tiles that go to bank 1 of the tile map
+        for bank in range(2) :
+            if bank == 0 :
+                yield vd.fill_from_palettes_end_to_bank0_tile_start()
             else :
-                pi = GBC_hex_format(format((palettes_index), "x").upper())
-            self.asm_source += (pi)
-            if (i+1)%10 != 0 :
-                self.asm_source += (",")
-            elif (i+1)%20 != 0:
-                self.asm_source += (" ; line "+str(np.floor(i/20).astype(int))+
-                    "\n")
+                yield vd.fill_from_bank0_tile_end_to_bank1_tile_start()
+            for i in range(256*bank, min(n_tiles, 256*(bank+1))) :
+                tile = self.tile_data[i]
+                yield (asm_db(tile[:8])+" ; tile "+str(i)+" / "+
+                    "$%02X" % i+"\n"+asm_db(tile[8:])+"\n")
+
+        # Write actual map, then palette map
+        for i, rows in enumerate((self.tile_map, self.attr_map)) :
+            if i == 0 :
+                yield vd.fill_from_bank1_tile_end_to_bank0_map_start()
             else :
-                self.asm_source += ("\n")
+                yield vd.fill_from_bank0_map_end_to_bank1_map_start()
+            for j, row in enumerate(rows) :
+                yield (asm_db(row[:10])+" ; line "+str(j)+"\n"+
+                    asm_db(row[10:])+"\n")
 
         #
-        self.asm_source += vd.fill_from_bank1_map_end_to_source_end()
+        yield vd.fill_from_bank1_map_end_to_source_end()
+
+    # Build the ROM image from the encoded palettes, tile data, tile map and
+    # attribute map (see create_rom)
+    def format_rom(self) :
+        return build_gbc_rom(self.palette_data, self.tile_data, 
+            self.tile_map, self.attr_map)
+
+    # Format the encoded palettes, tile data, tile map and attribute map as 
+    # rgbgfx-like binary files contents (see gbc_binaries)
+    def format_binaries(self) :
+        return gbc_binaries(self.palette_data, self.tile_data, 
+            self.tile_map, self.attr_map)
+
+    # Write the .2bpp, .tilemap, .attrmap and .pal binary files of the output
+    # to root+extension, where root is asked for if not given
+    def export_binaries(self, root=None, **kwargs) :
+        if not(self.output_is_GBC_compatible) :
+            return
+        if root is None :
+            from tkinter.filedialog import asksaveasfilename
+            root = asksaveasfilename(initialfile="main", 
+                filetypes=[("Game Boy binary files", ".2bpp")])
+            if not root :
+                return
+            root = os.path.splitext(root)[0]
+        self.encode_gbc(**kwargs)
+        for extension, data in self.format_binaries().items() :
+            with open(root+extension, "wb") as o :
+                o.write(data)
 
-    def export_asm(self) :
+    def export_asm(self, **kwargs) :
+        from tkinter.filedialog import asksaveasfile
 
         if not(self.output_is_GBC_compatible) :
             return
-        if self.asm_source == "" :
-            return
+        self.encode_gbc(**kwargs)
         file = asksaveasfile(mode='w', defaultextension=".asm",
             initialfile="main", filetypes=[("Assembly source file", ".asm")])
         if file :
-            file.write(self.asm_source)
+            self.write_asm(file)
+            file.close()
 
-        # Clear source after saving file
-        self.asm_source = ""
+    # Build the .gb ROM in process (default), or by compiling the asm source
+    # with RGBDS if kwargs["assembler"] is "rgbds" (see compile_gb_rgbds)
+    def compile_gb(self, **kwargs) :
+        from tkinter.filedialog import asksaveasfile
 
-    def compile_gb(self) :
-        
-        # Currently only for Windows
-        if platform != "win32":
+        if kwargs.get("assembler", "builtin") == "rgbds" :
+            self.compile_gb_rgbds()
             return
 
-        # Create asm source code
-        self.create_asm()
+        self.create_rom(**kwargs)
+        if not(self.output_is_GBC_compatible) :
+            return
+        file = asksaveasfile(mode='wb', defaultextension=".gb",
+            initialfile="main", filetypes=[("GBC file", ".gb")])
+        if file :
+            file.write(self.rom)
+            file.close()
+
+    # Compile the asm source with RGBDS (a system one on PATH, or the embedded
+    # one on Windows, see VIMPRO_Toolchain), in a temporary directory
+    def compile_gb_rgbds(self) :
+        from tkinter.filedialog import asksaveasfile
 
         if not(self.output_is_GBC_compatible) :
             return
-        if self.asm_source == "" :
+        toolchain = vtc.find_toolchain()
+        if toolchain is None :
+            print("Cannot compile .gb file:", vtc.toolchain_error())
             return
+        self.encode_gbc()
 
-        # Create dummy file which will be overwritten
-        file = asksaveasfile(mode='w', defaultextension=".gb",
+        file = asksaveasfile(mode='wb', defaultextension=".gb",
             initialfile="main", filetypes=[("GBC file", ".gb")])
-        if not file :
-            self.asm_source = ""
-            return
-        
-        # Define names
-        filename_with_ext = file.name.split("/")[-1]
-        filename_without_ext = filename_with_ext.split(".")[0]
-        folder_path = str(file.name).replace(filename_with_ext, "")
-
-        # Name root for temporary files written to disk
-        tmp = ''.join(
-                random.choice(
-                    string.ascii_uppercase+string.digits+string.ascii_lowercase
-                    ) for _ in range(29))
-
-        # Write asm source
-        with open(tmp+".asm", "w") as o :
-            o.write(self.asm_source)
-
-        # Write dlls
-        with open("libpng16.dll", "wb") as o:
-            o.write(vd.libpng16_dll_x64)
-        with open("zlib1.dll", "wb") as o:
-            o.write(vd.zlib1_dll_x64)
-
-        # Write and run exes to actually write the compiled .gb to the initial
-        # dummy file
-        with open(tmp+".exe", "wb") as o:
-            o.write(vd.rgbasm_exe_x64)
-        subprocess.call([tmp+".exe", "-o", tmp+".o", tmp+".asm"])
-        with open(tmp+".exe", "wb") as o:
-            o.write(vd.rgblink_exe_x64)
-        subprocess.call([tmp+".exe", "-o", file.name, tmp+".o"])
-        with open(tmp+".exe", "wb") as o:
-            o.write(vd.rgbfix_exe_x64)
-        subprocess.call([tmp+".exe", "-C", "-v", "-p", "0", file.name])
-
-        # Remove all leftovers
-        os.remove(tmp+".asm")
-        os.remove(tmp+".o")
-        os.remove(tmp+".exe")
-        os.remove("libpng16.dll")
-        os.remove("zlib1.dll")
-
-        # Reset source
-        self.asm_source = ""
-        
\ No newline at end of file
+        if file :
+            file.write(vtc.assemble_rom(self.iter_asm(), toolchain))
+            file.close()
+
+### FUNCTIONS #################################################################
+
+# Color quantizer backends, by name
+quantizers = {
+    "kmeans" : KMeans,
+    "mediancut" : MedianCut,
+    "octree" : Octree,
+    "wu" : Wu}
+
+# Return the quantizer backend selected by the quantizer kwarg and the kwargs
+# to construct it with. The quantizer can also be "<seeder>+kmeans" (e.g. 
+# "mediancut+kmeans"), in which case the k-means is seeded with the means 
+# found by the seeder and only runs refineiters iterations
+def quantizer_kwargs(**kwargs) :
+    name = kwargs.pop("quantizer", "kmeans")
+    refine_iters = kwargs.pop("refineiters", 3)
+    if "+" in name :
+        kwargs["init"], name = name.split("+", 1)
+        kwargs["maxiters"] = refine_iters
+    return quantizers[name], kwargs
+
+def run_quantizer(**kwargs) :
+    quantizer, kwargs = quantizer_kwargs(**kwargs)
+    return quantizer(**kwargs)
+
+# Coarse-to-fine k-means on the (height, width, channels) data. The k-means 
+# is first run on data subsampled (every stride-th pixel along each axis) down
+# to at most coarsepixels pixels, then on samples that are each 4 times larger,
+# up to the full data, each one warm-started from the means of the previous 
+# one. This stops as soon as the means move by less than tolerance between 
+# two levels, so that only a few iterations (if any) run at full resolution.
+# The other kwargs are those of run_quantizer, and single pass quantizers are
+# simply run on the full data. The returned KMeans has a levels attribute, 
+# i.e. the number of levels that were run
+def coarse_to_fine_kmeans(data, **kwargs) :
+    coarse_pixels = max(1, kwargs.pop("coarsepixels", 64*64))
+    tolerance = kwargs.pop("tolerance", 1.0)
+    print_info = kwargs.get("printinfo", False)
+    quantizer, kwargs = quantizer_kwargs(**kwargs)
+    if quantizer is not KMeans :
+        return quantizer(data=data.reshape(-1, data.shape[2]), **kwargs)
+
+    stride = 1
+    while data.shape[0]*data.shape[1] > coarse_pixels*stride*stride :
+        stride *= 2
+    levels = 0
+    while True :
+        level_data = data[::stride,::stride]
+        k_means = KMeans(data=level_data.reshape(-1, data.shape[2]), 
+            **kwargs)
+        levels += 1
+        means = k_means.raw_means
+        if print_info :
+            print("Coarse-to-fine k-means level", levels, "(stride "+
+                str(stride)+"):", k_means.iters, "iterations")
+        if stride == 1 or k_means.n <= k_means.k :
+            break
+        init = kwargs.get("init", None)
+        if (isinstance(init, np.ndarray) and init.shape == means.shape and 
+            np.max(np.sqrt(np.sum(np.square(means-init), axis=1))) < 
+            tolerance) :
+            break
+        kwargs["init"] = means
+        stride //= 2
+    k_means.levels = levels
+    return k_means
+
+def is_quantizer(name) :
+    names = str(name).split("+")
+    return (all(n in quantizers for n in names) and 
+        (len(names) == 1 or (len(names) == 2 and names[1] == "kmeans")))
+
+# Pack (n, 4) RGBA uint8 colors into (n,) uint32 keys (and back). Sorting the
+# keys sorts the colors in the same (lexicographic) order as np.unique(axis=0)
+def pack_colors(colors) :
+    colors = colors.astype(np.uint32)
+    return ((colors[:,0] << 24) | (colors[:,1] << 16) | (colors[:,2] << 8) | 
+        colors[:,3])
+
+def unpack_colors(keys) :
+    return np.stack([(keys >> 24) & 255, (keys >> 16) & 255, 
+        (keys >> 8) & 255, keys & 255], axis=1).astype(np.uint8)
+
+# Returns, for each row of data, the index of the nearest row of centers (as
+# uint8 if there are at most 256 centers) and the squared distance from it, 
+# plus the squared distance from the second nearest one if secondnearest is 
+# True. The (rows, centers, channels) difference tensor is only ever built 
+# for chunks of rows, sized so that all the chunks being processed at the same
+# time fit in memorybudget bytes. The chunks are dispatched to a pool of 
+# threads (numpy releases the GIL in these kernels) and their results are 
+# written straight into preallocated arrays
+def nearest_centers(data, centers, **kwargs) :
+    budget = kwargs.get("memorybudget", memory_budget)
+    threads = max(1, kwargs.get("threads", n_threads))
+    second_nearest = kwargs.get("secondnearest", False)
+    n = data.shape[0]
+    k = centers.shape[0]
+    indices = np.empty(n, dtype=np.uint8 if k <= 256 else np.intp)
+    min_dists = np.empty(n)
+    second_min_dists = np.empty(n) if second_nearest else None
+
+    # The difference tensor and its square, plus the distances, per row
+    row_bytes = 8*k*(2*centers.shape[1]+1)
+    chunk_size = max(1, int(budget/(row_bytes*threads)))
+
+    def map_chunk(start) :
+        end = min(start+chunk_size, n)
+        dists = np.sum(np.square(data[start:end,None,:]-centers[None,:,:]),
+            axis=2)
+        argmin_dists = np.argmin(dists, axis=1)
+        rows = np.arange(end-start)
+        indices[start:end] = argmin_dists
+        min_dists[start:end] = dists[rows, argmin_dists]
+        if second_nearest :
+            dists[rows, argmin_dists] = np.inf
+            second_min_dists[start:end] = np.min(dists, axis=1)
+
+    starts = range(0, n, chunk_size)
+    if threads == 1 or len(starts) == 1 :
+        for start in starts :
+            map_chunk(start)
+    else :
+        with ThreadPoolExecutor(max_workers=threads) as executor :
+            list(executor.map(map_chunk, starts))
+
+    if second_nearest :
+        return indices, min_dists, second_min_dists
+    return indices, min_dists
+
+# Return the (k, n) squared distances of the n rows of data from each of the k
+# centers. As in nearest_centers, they are computed in chunks of rows whose 
+# difference tensor and its square fit in memorybudget bytes
+def centers_distances(data, centers, **kwargs) :
+    budget = kwargs.get("memorybudget", memory_budget)
+    n = data.shape[0]
+    k = centers.shape[0]
+    dists = np.empty((k, n))
+    chunk_size = max(1, int(budget/(8*k*2*centers.shape[1])))
+    for start in range(0, n, chunk_size) :
+        end = min(start+chunk_size, n)
+        dists[:,start:end] = np.sum(np.square(data[None,start:end,:]-
+            centers[:,None,:]), axis=2)
+    return dists
+
+# Build the histogram of the colors in data, an (n, 4) RGBA array, and return
+# the unique colors (uint8, sorted), their counts and whether any transparent
+# color (alpha below 127) was present. Transparent colors are not counted, 
+# while the alpha of the others is forced to 255. The histogram is built in
+# chunks of chunksize pixels, so that memory stays bounded for large inputs.
+# If weights (one per row of data) are given, the counts are the (float) sums
+# of the weights of each color instead
+def color_histogram(data, **kwargs) :
+    chunk_size = kwargs.get("chunksize", 2**20)
+    weights = kwargs.get("weights", None)
+    alpha_threshold = 127
+    keys = np.empty(0, dtype=np.uint32)
+    counts = np.empty(0, dtype=np.int64 if weights is None else float)
+    has_transparency = False
+    for start in range(0, data.shape[0], chunk_size) :
+        chunk = data[start:start+chunk_size]
+        if chunk.dtype != np.uint8 :
+            chunk = np.clip(np.rint(chunk), 0, 255).astype(np.uint8)
+        opaque = chunk[:,3] >= alpha_threshold
+        if weights is not None :
+            chunk_weights = weights[start:start+chunk_size][opaque]
+        if not np.all(opaque) :
+            has_transparency = True
+            chunk = chunk[opaque]
+        chunk_keys = pack_colors(chunk)
+        chunk_keys[chunk[:,3] > alpha_threshold] |= 255
+        if weights is None :
+            chunk_keys, chunk_counts = np.unique(chunk_keys, 
+                return_counts=True)
+        else :
+            chunk_keys, inverse = np.unique(chunk_keys, return_inverse=True)
+            chunk_counts = np.bincount(inverse.reshape(-1), 
+                weights=chunk_weights, minlength=chunk_keys.shape[0])
+        if keys.shape[0] == 0 :
+            keys, counts = chunk_keys, chunk_counts
+            continue
+        keys, inverse = np.unique(np.concatenate([keys, chunk_keys]),
+            return_inverse=True)
+        counts = np.bincount(inverse, weights=np.concatenate(
+            [counts, chunk_counts])).astype(counts.dtype)
+    return unpack_colors(keys), counts, has_transparency
+
+# Sample a weighted coreset of (about) size colors from the color histogram
+# (colors, counts), see color_histogram, and return the sampled colors and
+# their weights. The weights are such that weighted sums over the coreset are
+# unbiased estimates of the corresponding sums over the histogram, so that the
+# coreset can stand in for the whole data in the k-means. With sampling
+# "coreset", colors are sampled with a probability that is half proportional
+# to their count and half to their count times their squared distance from
+# the mean color (i.e. a lightweight coreset, which favours the colors far 
+# from the bulk of the data). With sampling "stratified", colors are grouped
+# in the cells of a coarse (3 bits per channel) color grid, each of which 
+# gets a number of samples proportional to its count, but at least one, so
+# that rare colors are always represented. rng is a np.random.Generator
+def sample_colors(colors, counts, size, **kwargs) :
+    sampling = kwargs.get("sampling", "coreset")
+    rng = kwargs.get("rng", np.random.default_rng())
+    if colors.shape[0] <= size :
+        return colors, counts
+    counts = counts.astype(float)
+    total = np.sum(counts)
+
+    if sampling == "stratified" :
+        strata = pack_colors(colors >> 5)
+        order = np.argsort(strata, kind="stable")
+        strata, inverse = np.unique(strata[order], return_inverse=True)
+        strata_counts = np.bincount(inverse.reshape(-1), weights=counts[order])
+        strata_sizes = np.maximum(1, np.rint(size*strata_counts/total)).astype(
+            np.intp)
+        # Each sample picks a color within its stratum, with probability
+        # proportional to its count, through the cumulative counts of the 
+        # colors sorted by stratum
+        sorted_counts = counts[order]
+        cum_counts = np.cumsum(sorted_counts)
+        first = np.searchsorted(inverse.reshape(-1), 
+            np.arange(strata.shape[0]))
+        strata_starts = cum_counts[first]-sorted_counts[first]
+        sample_strata = np.repeat(np.arange(strata.shape[0]), strata_sizes)
+        targets = (strata_starts[sample_strata]+rng.random(
+            sample_strata.shape[0])*strata_counts[sample_strata])
+        samples = order[np.minimum(np.searchsorted(cum_counts, targets, 
+            side="right"), colors.shape[0]-1)]
+        weights = (strata_counts/strata_sizes)[sample_strata]
+    else :
+        mean = np.dot(counts, colors)/total
+        sq_dists = np.sum(np.square(colors-mean), axis=1)
+        probabilities = 0.5*counts/total
+        if np.dot(counts, sq_dists) > 0 :
+            probabilities += 0.5*counts*sq_dists/np.dot(counts, sq_dists)
+        cum_probabilities = np.cumsum(probabilities)
+        samples = np.minimum(np.searchsorted(cum_probabilities, rng.random(
+            size)*cum_probabilities[-1], side="right"), colors.shape[0]-1)
+        weights = counts[samples]/(size*probabilities[samples])
+
+    # Colors sampled more than once are merged
+    samples, inverse = np.unique(samples, return_inverse=True)
+    return colors[samples], np.bincount(inverse.reshape(-1), weights=weights)
+
+# Snap the (..., 4) RGBA colors in array to the grid of colors representable
+# with rgb_bits bits per (R, G, B) channel, expressed back in the 0-255 range.
+# 16 bits per channel means no conversion
+def quantize_colors(array, rgb_bits) :
+    if list(rgb_bits) == [16, 16, 16] :
+        return array
+    bit_scale = np.array([
+        float((2**(rgb_bits[0])-1))/255.0, 
+        float((2**(rgb_bits[1])-1))/255.0, 
+        float((2**(rgb_bits[2])-1))/255.0,
+        1.0])
+    return np.rint(np.divide(np.rint(np.multiply(array, bit_scale)), 
+        bit_scale))
+
+# Same as quantize_colors, but always rounding to integer colors (i.e. to the 
+# 8 bit grid with 16 bits per channel)
+def snap_colors(array, rgb_bits) :
+    return np.rint(quantize_colors(array, rgb_bits))
+
+# Snap the colors of a color histogram (see color_histogram) to the rgb_bits
+# grid and merge the counts of the colors that end up in the same bin
+def quantize_histogram(colors, counts, rgb_bits) :
+    if list(rgb_bits) == [16, 16, 16] :
+        return colors, counts
+    keys, inverse = np.unique(pack_colors(quantize_colors(colors, 
+        rgb_bits).astype(np.uint8)), return_inverse=True)
+    return unpack_colors(keys), np.bincount(inverse.reshape(-1), 
+        weights=counts).astype(counts.dtype)
+
+# Run a quantizer (see run_quantizer) on the (start_y, end_y, start_x, end_x)
+# region of the (height, width, channels) data
+def kmeans_region(data, region, **kwargs) :
+    start_y, end_y, start_x, end_x = region
+    region_data = data[start_y:end_y, start_x:end_x]
+    sampling = kwargs.pop("sampling", "nearest")
+    sample_size = kwargs.pop("samplesize", 128*128)
+    if kwargs.pop("coarsetofine", False) :
+        return coarse_to_fine_kmeans(region_data, **kwargs)
+    if sampling != "nearest" :
+        # The quantizer runs on a weighted sample of the region's colors (see
+        # sample_colors), whose own seed is drawn from the sampler's
+        rng = np.random.default_rng(kwargs.get("seed", None))
+        colors, counts, has_transparency = color_histogram(
+            region_data.reshape(-1, region_data.shape[2]))
+        colors, weights = sample_colors(colors, counts, sample_size, 
+            sampling=sampling, rng=rng)
+        kwargs["seed"] = rng.integers(2**63)
+        return run_quantizer(data=colors, weights=weights, 
+            transparency=has_transparency, **kwargs)
+    return run_quantizer(data=region_data.reshape(
+        region_data.shape[0]*region_data.shape[1], region_data.shape[2]), 
+        **kwargs)
+
+# Same as kmeans_region, but run in a worker process on data that is read 
+# from the shared memory block shm_name. Only the means (and the k-means 
+# iterations saved by snapping them, if reported) are sent back
+def kmeans_shared_region(shm_name, shape, dtype, region, **kwargs) :
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try :
+        data = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        start_y, end_y, start_x, end_x = region
+        # Copy the region out so that no view on the shared block survives
+        region_data = np.array(data[start_y:end_y, start_x:end_x])
+        del data
+    finally :
+        shm.close()
+    quantizer = kmeans_region(region_data, (0, region_data.shape[0], 0, 
+        region_data.shape[1]), **kwargs)
+    return quantizer.means, getattr(quantizer, "iters_saved", None)
+
+# Smallest integer dtype that can index the colors of palettes
+def index_dtype(palettes) :
+    return np.uint8 if palettes.shape[1] <= 256 else np.intp
+
+# Smallest integer dtype that can index the palettes themselves
+def palette_map_dtype(palettes) :
+    return np.uint8 if palettes.shape[0] <= 256 else np.intp
+
+# Return a (tiles_y, tiles_x, t_y, t_x, channels) view of the (height, width,
+# channels) data, split in a tiles_x by tiles_y grid of tiles
+def tiles_view(data, tiles_x, tiles_y) :
+    t_y = int(data.shape[0]/tiles_y)
+    t_x = int(data.shape[1]/tiles_x)
+    return data.reshape(tiles_y, t_y, tiles_x, t_x, data.shape[2]).transpose(
+        0, 2, 1, 3, 4)
+
+# GBC BG map attribute bits that flip a tile horizontally (x), vertically (y) 
+# or both ways (xy)
+tile_flip_attrs = {"x" : 0x20, "y" : 0x40, "xy" : 0x60}
+
+# Encode (..., 8, 8) arrays of color indices (0 to 3) into (..., 16) arrays of
+# Game Boy 2bpp tile data, i.e. for each row the byte of the low bits followed
+# by the byte of the high bits, the leftmost pixel being the msb
+def encode_2bpp(indices) :
+    indices = np.asarray(indices, dtype=np.uint8)
+    planes = np.stack((np.packbits(indices & 1, axis=-1), 
+        np.packbits(indices >> 1 & 1, axis=-1)), axis=-1)
+    return planes.reshape(indices.shape[:-2]+(16,))
+
+# Encode (..., channels) arrays of 8-bit RGB(A) colors into (..., 2) arrays of
+# Game Boy Color little endian RGB555 words
+def encode_rgb555(colors) :
+    rgb = (np.asarray(colors)[...,:3]//8).astype(np.uint16)
+    words = rgb[...,0] | rgb[...,1] << 5 | rgb[...,2] << 10
+    return words.astype("<u2").view(np.uint8).reshape(words.shape+(2,))
+
+# Build the 32 KB .gb ROM image (bytes) of the asm source (see 
+# ImageProcessor.create_asm) from the (n_palettes, 4, 2) palettes words, the 
+# (n_tiles, 16) tile data and the (18, 20) tile and attribute maps, i.e. the
+# ROM that rgbasm, rgblink and rgbfix -C -v -p 0 produce
+def build_gbc_rom(palette_data, tile_data, tile_map, attr_map) :
+    n_palettes = len(palette_data)
+    bank1 = len(tile_data) > 256
+
+    # Floating ROM0 sections of the source, as lists of (label, data) 
+    sections = [list(vd.rom_subroutines.items())]
+    for section in [[("palettesStart", palette_data)], 
+        [("tileTableBank0Start", tile_data[:256]), 
+        ("tileTableBank1Start", tile_data[256:])], 
+        [("tileMapStart", tile_map), ("palettesMapStart", attr_map)]] :
+        sections.append([(label, np.asarray(data, dtype=np.uint8).tobytes())
+            for label, data in section])
+
+    # The size of the setup code does not depend on the labels, so the free
+    # ROM0 space around the fixed sections is known before assembling it
+    labels = dict.fromkeys(["tileTableBank0End", "tileTableBank1End", 
+        "tileMapEnd", "palettesMapEnd"]+[label for section in sections 
+        for label, _ in section], 0)
+    code = vd.fill_rom_setup(n_palettes, bank1, labels)
+    gaps = [[0x0000, 0x0028], [0x0028+len(vd.rom_dma), 0x0040], 
+        [0x0040+len(vd.rom_vblank_interrupt), 0x0100], 
+        [0x0150+len(code), 0x8000]]
+
+    # Like rgblink, place the largest sections first, each in the first gap
+    # it fits in
+    rom = bytearray(0x8000)
+    for section in sorted(sections, key=lambda section : 
+        -sum(len(data) for _, data in section)) :
+        size = sum(len(data) for _, data in section)
+        gap = next((gap for gap in gaps if gap[1]-gap[0] >= size), None)
+        if gap is None :
+            raise ValueError("The ROM data does not fit in 32 KB")
+        address = gap[0]
+        gap[0] += size
+        for label, data in section :
+            labels[label] = address
+            rom[address:address+len(data)] = data
+            address += len(data)
+            if label.endswith("Start") :
+                labels[label[:-len("Start")]+"End"] = address
+
+    rom[0x28:0x28+len(vd.rom_dma)] = vd.rom_dma
+    rom[0x40:0x40+len(vd.rom_vblank_interrupt)] = vd.rom_vblank_interrupt
+    rom[0x100:0x104] = vd.rom_entry_point
+    rom[0x104:0x134] = vd.rom_nintendo_logo
+    rom[0x143] = 0xC0 # CGB only
+    code = vd.fill_rom_setup(n_palettes, bank1, labels)
+    rom[0x150:0x150+len(code)] = code
+
+    # Header checksum over $0134-$014C, then global checksum (big endian) of
+    # all the bytes but its own
+    checksum = 0
+    for byte in rom[0x134:0x14D] :
+        checksum = (checksum-byte-1) & 0xFF
+    rom[0x14D] = checksum
+    rom[0x14E:0x150] = (sum(rom) & 0xFFFF).to_bytes(2, "big")
+    return bytes(rom)
+
+# Contents of the rgbgfx-compatible binary files of the encoded (n_palettes,
+# 4, 2) palettes words, (n_tiles, 16) tile data and (18, 20) tile and attribute
+# maps, i.e. a dict of bytes by file extension, as meant to be INCBIN'd
+def gbc_binaries(palette_data, tile_data, tile_map, attr_map) :
+    return {".2bpp" : np.ascontiguousarray(tile_data, dtype=np.uint8).tobytes(),
+        ".tilemap" : np.ascontiguousarray(tile_map, dtype=np.uint8).tobytes(),
+        ".attrmap" : np.ascontiguousarray(attr_map, dtype=np.uint8).tobytes(),
+        ".pal" : np.ascontiguousarray(palette_data, dtype=np.uint8).tobytes()}
+
+# Format a sequence of bytes as an asm DB directive
+def asm_db(values) :
+    return "    DB "+",".join("$%02X" % v for v in values)
+
+# Score each of the (n_tiles, pixels, channels) tiles against each of the
+# (n_palettes, palette_size, channels) palettes, and return the (n_tiles,
+# n_palettes) scores (the lower, the better). The squared distances of all the
+# pixels of a chunk of tiles from all the palette colors are expanded as
+# |x|^2-2x.c+|c|^2, so that the bulk of the work is a matrix product (which is
+# exact for the integer colors the palettes are made of), and are then reduced
+# to the scores of the chunk by reduce (see tile_scorings), which receives
+# them as a (chunk_tiles, pixels, n_palettes, palette_size) array. Chunks are
+# sized to fit in memorybudget bytes
+def score_tiles(tiles, palettes, reduce, **kwargs) :
+    budget = kwargs.get("memorybudget", memory_budget)
+    n_tiles, n_tile_pixels, channels = tiles.shape
+    n_palettes, palette_size = palettes.shape[:2]
+    colors = palettes.reshape(n_palettes*palette_size, channels).astype(float)
+    colors_sq = np.sum(np.square(colors), axis=1)
+    scores = np.empty((n_tiles, n_palettes))
+    chunk_size = max(1, int(budget/(
+        24*n_tile_pixels*(colors.shape[0]+channels))))
+    for start in range(0, n_tiles, chunk_size) :
+        chunk = tiles[start:start+chunk_size].reshape(-1,
+            channels).astype(float)
+        sq_dists = np.dot(chunk, -2.0*colors.T)
+        sq_dists += np.sum(np.square(chunk), axis=1)[:,None]
+        sq_dists += colors_sq[None,:]
+        np.maximum(sq_dists, 0.0, out=sq_dists)
+        scores[start:start+chunk_size] = reduce(sq_dists.reshape(-1,
+            n_tile_pixels, n_palettes, palette_size))
+    return scores
+
+# Sum, over the pixels of the tile and the colors of the palette, of the
+# distance of each pixel from each color
+def reduce_avg_norm(sq_dists) :
+    np.sqrt(sq_dists, out=sq_dists)
+    return np.sum(np.sum(sq_dists, axis=1), axis=2)
+
+# Minimum, over the colors of the palette, of the sum over the pixels of the
+# tile of their distance from that color
+def reduce_min_norm(sq_dists) :
+    np.sqrt(sq_dists, out=sq_dists)
+    return np.min(np.sum(sq_dists, axis=1), axis=2)
+
+# Squared error of the tile once quantized with the palette, i.e. sum over the
+# pixels of the tile of the squared distance from their nearest palette color
+def reduce_sq_error(sq_dists) :
+    return np.sum(np.min(sq_dists, axis=3), axis=1)
+
+# Tile to palette scoring strategies, by name
+tile_scorings = {
+    "avgnorm" : reduce_avg_norm,
+    "minnorm" : reduce_min_norm,
+    "sqerror" : reduce_sq_error}
+
+# Immutable result of a headless processing run. image is the output PIL 
+# image, palettes a (n_palettes, palette_size, 4) array, palette_map a 
+# (tiles_y, tiles_x) array of indices into palettes (a single (1, 1) entry in
+# Default processor mode), index_map the (height, width) array of the color 
+# index of each pixel in the palette of its tile, asm the Game Boy Color 
+# assembly source, rom the .gb ROM image and binaries the contents of the 
+# rgbgfx-like binary files by extension (see gbc_binaries), all three None if
+# not in Game Boy Color compatibility mode, timings the time (in seconds) 
+# spent in the timed steps of the run (e.g. the tile scoring, by strategy 
+# name), iters_saved the k-means iterations saved by snapping the means (None
+# unless reportsavings is True). Arrays are read-only
+ProcessingResult = namedtuple("ProcessingResult", 
+    ["image", "palettes", "palette_map", "index_map", "asm", "rom", 
+    "binaries", "timings", "iters_saved"])
+
+# Raise a ValueError if the kwargs of process_image violate the Game Boy 
+# Color limits the GUI enforces, i.e. at most 4 colors per palette, at most 5
+# bits per channel and a 160x144 output made of (if tiled, i.e. in Tiled 
+# processor mode) tiles whose size divides it and is a multiple of the 8x8 
+# hardware tiles, with at most 8 palettes in the palettes grid
+def check_GBC_options(tiled, **kwargs) :
+    if kwargs.get("palettesize", 4) > 4 :
+        raise ValueError("The palette size cannot exceed 4 in Game Boy Color "
+            "compatibility mode")
+    if max(kwargs.get("rgbbits", [5, 5, 5])) > 5 :
+        raise ValueError("The RGB bits cannot exceed 5 in Game Boy Color "
+            "compatibility mode")
+    t_x, t_y = (1, 1)
+    if tiled :
+        t_x, t_y = kwargs.get("tilesize", (8, 8))
+        if (160 % t_x != 0 or 144 % t_y != 0 or t_x % 8 != 0 or 
+            t_y % 8 != 0) :
+            raise ValueError("The tile size must divide 160x144 and be a "
+                "multiple of 8x8 in Game Boy Color compatibility mode")
+        palettes_grid_x, palettes_grid_y = kwargs.get("palettesgridsize", 
+            (4, 2))
+        if palettes_grid_x*palettes_grid_y > 8 :
+            raise ValueError("The total palettes grid size (x*y) cannot "
+                "exceed 8 in Game Boy Color compatibility mode")
+    if "outsize" in kwargs and (kwargs["outsize"][0]*t_x, 
+        kwargs["outsize"][1]*t_y) != (160, 144) :
+        raise ValueError("The output resolution must be 160x144 in Game Boy "
+            "Color compatibility mode")
+
+# Pure library entry point, no tkinter canvas nor display required. image can
+# be either a PIL image or an array (height, width, 3 or 4), the kwargs are the
+# same ones accepted by ImageProcessor.process (procmode and compmode default
+# to the Default modes). A new ImageProcessor is used for every call, so that
+# this function can be safely run concurrently (e.g. from a process pool)
+def process_image(image, **kwargs) :
+    processor = ImageProcessor()
+    kwargs["image"] = image
+    kwargs.setdefault("procmode", processor.default_proc_mode_name)
+    kwargs.setdefault("compmode", processor.default_comp_mode_name)
+    if kwargs["procmode"] not in processor.proc_modes :
+        raise ValueError("Unknown processor mode: "+str(kwargs["procmode"]))
+    if kwargs["compmode"] not in processor.comp_modes :
+        raise ValueError("Unknown compatibility mode: "+
+            str(kwargs["compmode"]))
+    if not is_quantizer(kwargs.get("quantizer", "kmeans")) :
+        raise ValueError("Unknown quantizer: "+str(kwargs["quantizer"]))
+    if kwargs.get("tilescoring", "avgnorm") not in tile_scorings :
+        raise ValueError("Unknown tile scoring strategy: "+
+            str(kwargs["tilescoring"]))
+    if kwargs["compmode"] == processor.GBC_comp_mode_name :
+        check_GBC_options(
+            kwargs["procmode"] == processor.tiled_proc_mode_name, **kwargs)
+    if not processor.process(**kwargs) :
+        raise ValueError("Invalid processing options for the selected modes")
+
+    asm = None
+    rom = None
+    binaries = None
+    if processor.output_is_GBC_compatible :
+        processor.encode_gbc(tileflips=kwargs.get("tileflips", False))
+        asm = processor.format_asm()
+        rom = processor.format_rom()
+        binaries = processor.format_binaries()
+
+    palettes = np.array(processor.palettes)
+    palettes.setflags(write=False)
+    palette_map = np.array(processor.palette_map)
+    palette_map.setflags(write=False)
+    index_map = np.array(processor.index_map)
+    index_map.setflags(write=False)
+    return ProcessingResult(image=processor.output_image, palettes=palettes,
+        palette_map=palette_map, index_map=index_map, asm=asm, rom=rom,
+        binaries=binaries, timings=dict(processor.timings), 
+        iters_saved=processor.iters_saved)
@@ -0,0 +1,116 @@
+###############################################################################
+##                                                                           ##
+##             ________________________________     _________   _________    ##
+##            // ____  ____  _________________/    // ____  /  // ____  /    ##
+##           // /  // /  // /                     // /  // /  // /  // /     ##
+##          // /  // /  // /_____  _________     // /__// /__//_/__// /      ##
+##         // /  // /  // ______/ // ______/    // __________________/       ##
+##        // /  // /  // /_______//_/_____     // /        // /_____         ##
+##       // /  // /  // _______________  /    // /        //_____  /         ##
+##      // /  // /  // /_____  // /__// /    // /        ___   // /          ##
+##     // /__// /  // ______/ //_______/    // /        // /__// /           ##
+##    //_______/  //_/                     //_/        //_______/            ##
+##                                                                           ##
+##                                                             Stefan Radman ##
+###############################################################################
+
+### IMPORTS ###################################################################
+
+import os
+import re
+import sys
+import shutil
+import subprocess
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+import VIMPRO_Data as vd
+
+### DATA ######################################################################
+
+# RGBDS tools needed to build a ROM from the asm source
+tools = ["rgbasm", "rgblink", "rgbfix"]
+
+# (major, minor) RGBDS versions the asm source is written for, i.e. those of
+# the embedded v0.5.0 toolchain. Later versions reject the "name: MACRO" 
+# syntax and no longer add a nop after halt, so they would fail or build a 
+# different ROM
+compatible_versions = [(0, 5)]
+
+### FUNCTIONS #################################################################
+
+# Return the (major, minor, patch) version of the rgbasm at path, None if it
+# cannot be found out
+def toolchain_version(path) :
+    try :
+        output = subprocess.run([path, "--version"], capture_output=True, 
+            text=True, timeout=10)
+    except (OSError, subprocess.SubprocessError) :
+        return None
+    match = re.search(r"(\d+)\.(\d+)\.(\d+)", output.stdout+output.stderr)
+    if match is None :
+        return None
+    return tuple(int(n) for n in match.groups())
+
+# Return the paths of the RGBDS tools as a dict by tool name. On Windows, 
+# those of the embedded toolchain, extracted once to the persistent cache 
+# (see VIMPRO_Data.extract_toolchain), otherwise those of a system RGBDS if 
+# all the tools are on PATH and their version is compatible (see 
+# compatible_versions). Return None if no compatible toolchain is available
+def find_toolchain() :
+    if sys.platform == "win32" :
+        folder = vd.extract_toolchain()
+        return {tool : os.path.join(folder, tool+".exe") for tool in tools}
+    paths = {tool : shutil.which(tool) for tool in tools}
+    if not all(paths.values()) :
+        return None
+    version = toolchain_version(paths["rgbasm"])
+    if version is None or version[:2] not in compatible_versions :
+        return None
+    return paths
+
+# Error raised when no compatible toolchain is available
+def toolchain_error() :
+    return RuntimeError("No compatible RGBDS toolchain found (v"+", v".join(
+        str(major)+"."+str(minor)+".x" for major, minor in 
+        compatible_versions)+" required on PATH)")
+
+# Assemble, link and fix the asm source (a string or an iterable of strings,
+# see ImageProcessor.iter_asm) with the RGBDS toolchain (as returned by
+# find_toolchain) in a temporary directory of its own, and return the ROM
+# bytes. Raises subprocess.CalledProcessError if any of the tools fails
+def assemble_rom(source, toolchain=None) :
+    if toolchain is None :
+        toolchain = find_toolchain()
+        if toolchain is None :
+            raise toolchain_error()
+    if isinstance(source, str) :
+        source = [source]
+    with tempfile.TemporaryDirectory(prefix="VIMPRO-") as folder :
+        asm = os.path.join(folder, "main.asm")
+        obj = os.path.join(folder, "main.o")
+        rom = os.path.join(folder, "main.gb")
+        with open(asm, "w") as o :
+            for chunk in source :
+                o.write(chunk)
+        for command in [[toolchain["rgbasm"], "-o", obj, asm],
+            [toolchain["rgblink"], "-o", rom, obj],
+            [toolchain["rgbfix"], "-C", "-v", "-p", "0", rom]] :
+            subprocess.run(command, cwd=folder, check=True,
+                capture_output=True)
+        with open(rom, "rb") as i :
+            return i.read()
+
+# Assemble all the asm sources concurrently, running at most jobs (by default
+# the number of CPUs) toolchains at a time, and return the list of ROM bytes
+# in the same order
+def compile_roms(sources, jobs=None, toolchain=None) :
+    if toolchain is None :
+        toolchain = find_toolchain()
+        if toolchain is None :
+            raise toolchain_error()
+    jobs = max(1, jobs or os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=jobs) as executor :
+        return list(executor.map(lambda source : assemble_rom(source,
+            toolchain), sources))